@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+
+import heatmap_dataset_processing
+import instruction_tuning_processing
+import prompt_processing
+from synthetic_mimic_eye import generate_synthetic_tree
+
+# Times the pipeline stages on a synthetic tree (see synthetic_mimic_eye.py) and
+# compares them with a saved baseline, e.g.
+#   python benchmark.py --save-baseline benchmarks/baseline.json
+#   python benchmark.py --compare benchmarks/baseline.json
+
+@contextmanager
+def working_directory(path):
+    cwd=os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def timeit(fn, repeat=3, number=1):
+    # Seconds per call over `repeat` rounds of `number` calls
+    times=[]
+    for _ in range(repeat):
+        start=time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter()-start)/number)
+    return {'median_s': float(np.median(times)), 'min_s': float(np.min(times)), 'repeat': repeat, 'number': number}
+
+def run_benchmarks(workdir, patients=20, repeat=3, workers=1, image_size=(2048, 2500)):
+    paths=generate_synthetic_tree(os.path.join(workdir, 'physionet'), patients=patients, image_size=image_size)
+    results={}
+    with working_directory(workdir):
+        rng=np.random.default_rng(0)
+        gaze_data=pd.DataFrame({'x_position': rng.uniform(0, 2048, 200), 'y_position': rng.uniform(0, 2500, 200),
+                                'Time (in secs)': rng.uniform(0.05, 1.0, 200)})
+        results['generate_heatmap']=timeit(lambda: heatmap_dataset_processing.generate_heatmap(None, 419, 512, 419/2048, 512/2500, gaze_data), repeat, number=20)
+
+        results['generator_init_cold']=timeit(lambda: heatmap_dataset_processing.GazeHeatMapGenerator(**paths, rebuild_index=True), repeat)
+        results['generator_init_warm']=timeit(lambda: heatmap_dataset_processing.GazeHeatMapGenerator(**paths), repeat)
+        generator=heatmap_dataset_processing.GazeHeatMapGenerator(**paths)
+        studies=generator.patient_subjects
+        results['process_patient']=timeit(lambda: [generator.process_patient(bp) for bp in studies], repeat)
+        results['process_patient']['per_study_s']=results['process_patient']['median_s']/len(studies)
+
+        results['process_all']=timeit(lambda: generator.process_all(), repeat)
+        if workers>1:
+            results[f'process_all_workers{workers}']=timeit(lambda: generator.process_all(workers=workers), repeat)
+
+        # The stages consume process_all's output as written
+        results['process_train']=timeit(lambda: instruction_tuning_processing.process_train('mimic-eye-heat-train.jsonl', 'instruction_miccai_heatmap.json', seed=0), repeat)
+        test=list(prompt_processing.read_jsonl('mimic-eye-heat-test.jsonl'))
+        results['prompt_process']=timeit(lambda: prompt_processing.process_stream(test), repeat)
+        results['process_train']['records']=sum(1 for _ in instruction_tuning_processing.read_jsonl('mimic-eye-heat-train.jsonl'))
+    results['prompt_process']['records']=len(test)
+    return results
+
+def machine_info():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+def compare(results, baseline, tolerance):
+    # A case regresses when its median is more than `tolerance` slower than the baseline
+    regressions=[]
+    for name, result in results.items():
+        if name not in baseline['results']:
+            print(f'{name:28s} {result["median_s"]*1000:10.2f} ms  (no baseline)')
+            continue
+        ratio=result['median_s']/baseline['results'][name]['median_s']
+        flag='REGRESSION' if ratio>1+tolerance else ''
+        print(f'{name:28s} {result["median_s"]*1000:10.2f} ms  x{ratio:5.2f} vs baseline {flag}')
+        if flag:
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="also time process_all with this many workers")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[2048, 2500], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument("--workdir", type=str, default=None, help="keep the synthetic tree and outputs here instead of a temporary directory")
+    parser.add_argument("--output", type=str, default=None, help="write the results as JSON")
+    parser.add_argument("--save-baseline", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None, help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    config={'patients': args.patients, 'repeat': args.repeat, 'workers': args.workers, 'image_size': args.image_size}
+    workdir=args.workdir or tempfile.mkdtemp(prefix='mimic-eye-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results=run_benchmarks(workdir, patients=args.patients, repeat=args.repeat, workers=args.workers, image_size=tuple(args.image_size))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report={'machine': machine_info(), 'config': config, 'results': results}
+
+    for path in [args.output, args.save_baseline]:
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline=json.load(f)
+        if baseline['config']!=config or baseline['machine']!=report['machine']:
+            print('warning: baseline was recorded with a different config or machine')
+        sys.exit(1 if compare(results, baseline, args.tolerance) else 0)
+    for name, result in results.items():
+        print(f'{name:28s} {result["median_s"]*1000:10.2f} ms')
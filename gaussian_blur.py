@@ -0,0 +1,71 @@
+import numpy as np
+from functools import lru_cache
+from scipy.ndimage import correlate1d, gaussian_filter
+
+# Gaussian blur backends for (..., height, width) intensity maps. All of them use
+# scipy's kernel (truncated at 4 sigma) and 'reflect' boundary handling, so they
+# agree with blur_scipy up to floating point rounding.
+TRUNCATE=4.0
+
+@lru_cache(maxsize=None)
+def gaussian_kernel1d(sigma, truncate=TRUNCATE):
+    radius=int(truncate*float(sigma)+0.5)
+    x=np.arange(-radius, radius+1)
+    phi=np.exp(-0.5/float(sigma)**2*x**2)
+    return phi/phi.sum()
+
+@lru_cache(maxsize=None)
+def gaussian_stamp(sigma, truncate=TRUNCATE):
+    kernel=gaussian_kernel1d(sigma, truncate)
+    return np.outer(kernel, kernel)
+
+def reflect_index(idx, n):
+    # scipy.ndimage 'reflect' mode: (d c b a | a b c d | d c b a)
+    idx=np.mod(idx, 2*n)
+    return np.where(idx>=n, 2*n-1-idx, idx)
+
+def blur_scipy(intensity_map, sigma):
+    # Reference dense float64 path
+    return gaussian_filter(intensity_map, sigma=(0,)*(intensity_map.ndim-2)+(sigma, sigma))
+
+def blur_separable(intensity_map, sigma):
+    # Two float32 1-D passes with the cached kernel, one per image axis; leading
+    # batch axes are left alone
+    kernel=gaussian_kernel1d(sigma).astype(np.float32)
+    blurred=correlate1d(intensity_map.astype(np.float32), kernel, axis=-2, output=np.float32, mode='reflect')
+    return correlate1d(blurred, kernel, axis=-1, output=np.float32, mode='reflect')
+
+def fold_reflect(padded, n, radius, axis):
+    # Adds the `radius` padding on both ends of axis back onto the n inner entries,
+    # with 'reflect' indexing
+    padded=np.moveaxis(padded, axis, 0)
+    if radius>n:
+        # The stamp is wider than the map, so the padding reflects more than once
+        folded=np.zeros((n,)+padded.shape[1:], dtype=padded.dtype)
+        np.add.at(folded, reflect_index(np.arange(-radius, n+radius), n), padded)
+    else:
+        folded=padded[radius:radius+n].copy()
+        folded[:radius]+=padded[radius-1::-1] if radius else 0
+        folded[n-radius:]+=padded[:n+radius-1:-1] if radius else 0
+    return np.moveaxis(folded, 0, axis)
+
+def blur_stamp(intensity_map, sigma):
+    # Splat a precomputed Gaussian stamp at every non-zero pixel of a map padded by
+    # the stamp radius, then fold the padding back once; cost grows with the number
+    # of fixations rather than the image area
+    stamp=gaussian_stamp(sigma)
+    size=len(stamp)
+    radius=size//2
+    height, width=intensity_map.shape[-2:]
+    padded=np.zeros(intensity_map.shape[:-2]+(height+2*radius, width+2*radius))
+    for index in zip(*np.nonzero(intensity_map)):
+        *batch, y, x=index
+        padded[tuple(batch)+(slice(y, y+size), slice(x, x+size))]+=intensity_map[index]*stamp
+    return fold_reflect(fold_reflect(padded, height, radius, -2), width, radius, -1)
+
+BLUR_BACKENDS={'scipy': blur_scipy, 'separable': blur_separable, 'stamp': blur_stamp}
+
+def gaussian_blur(intensity_map, sigma, backend='scipy'):
+    if backend not in BLUR_BACKENDS:
+        raise ValueError(f'unknown blur backend {backend!r}, expected one of {sorted(BLUR_BACKENDS)}')
+    return BLUR_BACKENDS[backend](intensity_map, sigma)
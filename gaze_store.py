@@ -0,0 +1,120 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+COLUMNS=['x', 'y', 'duration', 'timestamp_start_fixation', 'timestamp_end_fixation', 'source']
+SOURCES={'EG': 0, 'REFLACX': 1}
+GAZE_STORE_VERSION=1
+
+def read_fixations(mimic_eye_path, patient_id, EG):
+    # Parse a study's fixations.csv into the store columns, in original image pixels.
+    # Returns the relative path that was read and a dict of arrays.
+    if EG:
+        path=f'patient_{patient_id}/EyeGaze/fixations.csv'
+        gaze_data=pd.read_csv(os.path.join(mimic_eye_path, path), usecols=['Time (in secs)', 'X_ORIGINAL', 'Y_ORIGINAL'])
+        time=gaze_data['Time (in secs)'].to_numpy(dtype=float)
+        fixations={'x': gaze_data['X_ORIGINAL'].to_numpy(dtype=float),
+                   'y': gaze_data['Y_ORIGINAL'].to_numpy(dtype=float),
+                   'duration': np.diff(time, prepend=0.0),
+                   'timestamp_start_fixation': np.concatenate([[0.0], time[:-1]]),
+                   'timestamp_end_fixation': time}
+    else:
+        gaze_data=None
+        for i in os.listdir(os.path.join(mimic_eye_path, f'patient_{patient_id}/REFLACX/main_data/')):
+            path=f'patient_{patient_id}/REFLACX/main_data/{i}/fixations.csv'
+            try:
+                gaze_data=pd.read_csv(os.path.join(mimic_eye_path, path))
+            except:
+                gaze_data=None
+            if gaze_data is not None:
+                break
+        if gaze_data is None:
+            raise FileNotFoundError(f'no readable REFLACX fixations for patient_{patient_id}')
+        start=gaze_data['timestamp_start_fixation'].to_numpy(dtype=float)
+        end=gaze_data['timestamp_end_fixation'].to_numpy(dtype=float)
+        fixations={'x': gaze_data['x_position'].to_numpy(dtype=float),
+                   'y': gaze_data['y_position'].to_numpy(dtype=float),
+                   'duration': end-start,
+                   'timestamp_start_fixation': start,
+                   'timestamp_end_fixation': end}
+    fixations['source']=np.full(len(fixations['x']), SOURCES['EG' if EG else 'REFLACX'], dtype=np.uint8)
+    return path, fixations
+
+def file_stat(path):
+    st=os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def build_gaze_store(mimic_eye_path, studies, output_path):
+    # Pack the fixations of every study into one .npy file per column plus an
+    # index of study_id -> [start, stop) row offsets
+    os.makedirs(output_path, exist_ok=True)
+    chunks={c: [] for c in COLUMNS}
+    index={}
+    offset=0
+    failures={}
+    for study_id, study in tqdm(sorted(studies.items())):
+        try:
+            path, fixations=read_fixations(mimic_eye_path, study['patient_id'], study['in_eye_gaze'])
+        except Exception as e:
+            failures[study_id]=f'{type(e).__name__}: {e}'
+            continue
+        for c in COLUMNS:
+            chunks[c].append(fixations[c])
+        n=len(fixations['x'])
+        index[study_id]={'offset': [offset, offset+n], 'file': path, 'stat': file_stat(os.path.join(mimic_eye_path, path))}
+        offset+=n
+    for c in COLUMNS:
+        dtype=np.uint8 if c=='source' else np.float64
+        np.save(os.path.join(output_path, f'{c}.npy'), np.concatenate(chunks[c]).astype(dtype) if chunks[c] else np.zeros(0, dtype=dtype))
+    with open(os.path.join(output_path, 'index.json'), 'w') as f:
+        json.dump({'version': GAZE_STORE_VERSION, 'studies': index}, f)
+    return failures
+
+class GazeStore:
+    # Read-only, memory-mapped view of a store written by build_gaze_store
+    def __init__(self, path):
+        self.path=path
+        with open(os.path.join(path, 'index.json')) as f:
+            index=json.load(f)
+        if index.get('version')!=GAZE_STORE_VERSION:
+            raise ValueError(f'{path} was written by an incompatible version, rebuild it with gaze_store.py')
+        self.studies=index['studies']
+        self.columns={c: np.load(os.path.join(path, f'{c}.npy'), mmap_mode='r') for c in COLUMNS}
+
+    def __getstate__(self):
+        # Reopen the memory maps in spawned workers instead of pickling their contents
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def get(self, study_id, mimic_eye_path=None):
+        # Zero-copy column slices for a study, or None if it is missing or its
+        # source fixations.csv changed since the store was built
+        study=self.studies.get(study_id)
+        if study is None:
+            return None
+        if mimic_eye_path is not None:
+            source_path=os.path.join(mimic_eye_path, study['file'])
+            if not os.path.exists(source_path) or file_stat(source_path)!=study['stat']:
+                return None
+        start, stop=study['offset']
+        return {c: self.columns[c][start:stop] for c in COLUMNS}
+
+if __name__ == '__main__':
+    import argparse
+    from heatmap_dataset_processing import load_study_index
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mimic-eye-path", type=str, default='physionet.org/files/mimic-eye')
+    parser.add_argument("--mimic-cxr-path", type=str, default='physionet.org/files/mimic-cxr/2.0.0')
+    parser.add_argument("--study-index", type=str, default='mimic-eye-study-index.pkl')
+    parser.add_argument("--output", type=str, default='mimic-eye-gaze-store')
+    args = parser.parse_args()
+
+    study_index=load_study_index(args.study_index, args.mimic_eye_path, args.mimic_cxr_path)
+    failures=build_gaze_store(args.mimic_eye_path, study_index['studies'], args.output)
+    if failures:
+        print(f'{len(failures)} studies have no readable fixations and were left out of the store')
@@ -1,137 +1,482 @@
 import pandas as pd
 from glob import glob
-from collections import Counter
+from collections import Counter, deque
 from tqdm import tqdm
-from PIL import Image, ImageDraw, ImageFont
-import imageio
+from PIL import Image
 import numpy as np
 import warnings
-from scipy.ndimage import gaussian_filter
 import re
 import os
 import json
+import hashlib
+import pickle
+import multiprocessing as mp
+from contextlib import nullcontext
+from functools import partial
+from gaze_store import GazeStore, read_fixations
+from gaussian_blur import BLUR_BACKENDS, gaussian_blur
+from heatmaps import COLORMAPS, accumulate_intensity, long_side_size, normalize_intensity, window_durations
+from profiling import NULL_PROFILE, StudyProfile, cprofile_hook, write_profiles
+from io_pipeline import BackgroundWriter, prefetch
 warnings.filterwarnings("ignore")
 
-def generate_heatmap(base_image, width, height, x_ratio, y_ratio, gaze_data, radius=5, _x='x_position', _y='y_position'):
-    data=gaze_data.to_dict(orient='records')
-    # Create a blank image with the specified dimensions
-    heatmap_image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(heatmap_image)
-    
+def gaze_columns(gaze_data, _x='x_position', _y='y_position'):
+    return gaze_data[_x].to_numpy(), gaze_data[_y].to_numpy(), gaze_data['Time (in secs)'].to_numpy()
+
+def render_heatmap(x, y, duration, width, height, radius=5, blur_backend='scipy', colormap='red'):
+    # x and y are already scaled to the (width, height) target
     # Generate the intensity map from fixation data
-    intensity_map = np.zeros((height, width))
-    frames = []
-    frames_captioned = []
-    for gaze in data:
-        x, y = gaze[_x]*x_ratio, gaze[_y]*y_ratio
-        x=int(x)
-        y=int(y)
-        if y>=height-radius or y<0+radius  or x<0+radius  or x>=width-radius:
-            continue
-        intensity_map[y][x] += gaze['Time (in secs)']
-        
+    intensity_map=accumulate_intensity(x, y, duration, width, height, radius)
     # Apply Gaussian blur to smooth out the heatmap
-    intensity_map = gaussian_filter(intensity_map, sigma=radius)
-    
-    # Normalize intensity map
-    intensity_map /= np.max(intensity_map)
+    intensity_map = gaussian_blur(intensity_map, radius, blur_backend)
+    intensity_map = normalize_intensity(intensity_map)
+    return Image.fromarray(COLORMAPS[colormap](intensity_map), 'RGBA')
+
+def generate_heatmap(base_image, width, height, x_ratio, y_ratio, gaze_data, radius=5, _x='x_position', _y='y_position', blur_backend='scipy'):
+    x, y, duration=gaze_columns(gaze_data, _x, _y)
+    return render_heatmap(x*x_ratio, y*y_ratio, duration, width, height, radius, blur_backend)
+
+def resize_long_side(image, target_size, size=None):
+    # size is the original (width, height) when image was decoded at a reduced scale
+    return image.resize(long_side_size(*(size or image.size), target_size))
+
+DECODE_MODES=['full', 'draft']
+OUTPUT_FORMATS={'png': '.png', 'webp': '.webp', 'jpeg': '.jpg', 'npy': '.npy'}
+
+def save_params(output_format, quality=None, compress_level=None):
+    # Image.save keyword arguments for an output format; None keeps PIL's defaults
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'unknown output format {output_format!r}, expected one of {sorted(OUTPUT_FORMATS)}')
+    params={}
+    if output_format=='png' and compress_level is not None:
+        params['compress_level']=compress_level
+    if output_format in ('webp', 'jpeg') and quality is not None:
+        params['quality']=quality
+    return params
+
+# MIMIC-Ext-MIMIC-CXR-VQA names every image by its 512px PNG
+VQA_IMAGE_SUFFIX='_512.png'
+
+def vqa_image_path(image_id):
+    # VQA join key of a resized image_id (<dicom_id>_<size>.<ext>), whatever size and
+    # format the outputs are rendered in
+    return image_id.rsplit('_', 1)[0]+VQA_IMAGE_SUFFIX
+
+VARIANT_DEFAULTS={'radius': 5, 'target_size': 512, 'blur_backend': 'scipy', 'colormap': 'red', 'time_window': None}
+
+def resolve_variants(variants=None, **defaults):
+    # Fill every variant spec with the defaults; the first variant is the one
+    # written to _heatmap.png and referenced by image_id/heatmap_image_id
+    defaults={**VARIANT_DEFAULTS, **defaults}
+    resolved=[]
+    for i, variant in enumerate(variants or [{}]):
+        unknown=set(variant)-set(VARIANT_DEFAULTS)-{'name'}
+        if unknown:
+            raise ValueError(f'unknown variant keys {sorted(unknown)}')
+        variant={**defaults, 'name': 'default' if i==0 else f'variant{i}', **variant}
+        if variant['colormap'] not in COLORMAPS:
+            raise ValueError(f"unknown colormap {variant['colormap']!r}, expected one of {sorted(COLORMAPS)}")
+        if variant['blur_backend'] not in BLUR_BACKENDS:
+            raise ValueError(f"unknown blur backend {variant['blur_backend']!r}, expected one of {sorted(BLUR_BACKENDS)}")
+        if variant['time_window'] is not None:
+            variant['time_window']=[float(t) for t in variant['time_window']]
+        resolved.append(variant)
+    names=[variant['name'] for variant in resolved]
+    if len(set(names))!=len(names):
+        raise ValueError(f'variant names must be unique, got {names}')
+    return resolved
+
+def parse_variant(spec):
+    # 'name:key=value,...', e.g. 'early:time_window=0-5,colormap=jet'
+    name, _, options=spec.partition(':')
+    variant={'name': name}
+    for option in filter(None, options.split(',')):
+        key, _, value=option.partition('=')
+        if key in ('radius', 'target_size'):
+            value=int(value)
+        elif key=='time_window':
+            value=[float(t) for t in value.split('-')]
+        variant[key]=value
+    return variant
+
+def iter_json_array(path, chunk_size=1<<20):
+    # Yield the items of a top-level JSON array while holding about one chunk of the file
+    decoder=json.JSONDecoder()
+    with open(path) as f:
+        # expect: '[' first, then an item or ']', then ',' or ']' after every item
+        # and an item after every ','
+        buffer, pos, expect=f.read(chunk_size), 0, 'open'
+        while True:
+            while pos<len(buffer) and buffer[pos] in ' \t\r\n':
+                pos+=1
+            if pos==len(buffer):
+                buffer, pos=f.read(chunk_size), 0
+                if not buffer:
+                    raise ValueError(f'{path}: unterminated JSON array')
+                continue
+            char=buffer[pos]
+            if expect=='open':
+                if char!='[':
+                    raise ValueError(f'{path}: expected a JSON array')
+                expect, pos='first', pos+1
+                continue
+            if char==']' and expect in ('first', 'delimiter'):
+                return
+            if expect=='delimiter':
+                if char!=',':
+                    raise ValueError(f'{path}: malformed JSON array')
+                expect, pos='item', pos+1
+                continue
+            if char in ',]':
+                raise ValueError(f'{path}: malformed JSON array')
+            # An item is complete only once a delimiter follows it: a number or literal
+            # cut at the chunk boundary would otherwise decode as a shorter value
+            try:
+                item, end=decoder.raw_decode(buffer, pos)
+                while end<len(buffer) and buffer[end] in ' \t\r\n':
+                    end+=1
+                complete=end<len(buffer) and buffer[end] in ',]'
+            except json.JSONDecodeError:
+                complete=False
+            if not complete:
+                chunk=f.read(chunk_size)
+                if not chunk:
+                    raise ValueError(f'{path}: malformed JSON array')
+                buffer, pos=buffer[pos:]+chunk, 0
+                continue
+            yield item
+            expect, pos='delimiter', end
+
+def load_vqa(mimic_cxr_vqa_path, image_paths=None):
+    # Stream train/valid/test.json keeping image_path, question and the first answer
+    # (as categoricals) for questions with at least one answer, optionally only for image_paths
+    columns={'image_path': [], 'answer': [], 'question': [], 'n_answers': []}
+    for split in ['train', 'valid', 'test']:
+        for item in iter_json_array(os.path.join(mimic_cxr_vqa_path, f'{split}.json')):
+            if image_paths is not None and item['image_path'] not in image_paths:
+                continue
+            answer=item['answer']
+            if not isinstance(answer, list) or len(answer)==0:
+                continue
+            columns['image_path'].append(item['image_path'])
+            columns['answer'].append(answer[0])
+            columns['question'].append(item['question'])
+            columns['n_answers'].append(len(answer))
+    return pd.DataFrame({'image_path': pd.Categorical(columns['image_path']),
+                         'answer': pd.Categorical(columns['answer']),
+                         'question': columns['question'],
+                         'n_answers': np.array(columns['n_answers'], dtype=np.int32)})
+
+def yes_no_questions(vqadf):
+    # The first single yes/no question of every image
+    yes_no=(vqadf['n_answers']==1)&vqadf['answer'].isin(['yes', 'no'])
+    return vqadf[yes_no.to_numpy()].drop_duplicates(subset='image_path')
+
+def vqa_lookup(vqadf):
+    # image_path -> [{'answer', 'question'}] in table order
+    lookup={}
+    for image_path, answer, question in zip(vqadf['image_path'].tolist(), vqadf['answer'].tolist(), vqadf['question'].tolist()):
+        lookup.setdefault(image_path, []).append({'answer': answer, 'question': question})
+    return lookup
+
+def file_digest(path, previous=None):
+    # Content hash of a file; reuse the previous digest while size and mtime are unchanged
+    st=os.stat(path)
+    if previous is not None and previous['size']==st.st_size and previous['mtime_ns']==st.st_mtime_ns:
+        return previous
+    sha1=hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            sha1.update(chunk)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': sha1.hexdigest()}
+
+class BuildManifest:
+    # Per-study record of input digests, render parameters and outputs, keyed by
+    # the study directory relative to mimic_eye_path; version 2 records carry findings_org
+    version=2
+
+    def __init__(self, path):
+        self.path=path
+        self.studies={}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest=json.load(f)
+            if manifest.get('version')==self.version:
+                self.studies=manifest['studies']
+
+    def previous_inputs(self, key):
+        return self.studies.get(key, {}).get('inputs', {})
+
+    def lookup(self, key, fingerprint, root):
+        # Return the stored record if inputs, parameters and outputs are all still valid
+        entry=self.studies.get(key)
+        if entry is None or entry['params']!=fingerprint['params'] or entry['rows']!=fingerprint['rows']:
+            return None
+        if {k: v['sha1'] for k, v in entry['inputs'].items()}!={k: v['sha1'] for k, v in fingerprint['inputs'].items()}:
+            return None
+        for output, size in entry['outputs'].items():
+            output_path=os.path.join(root, output)
+            if not os.path.exists(output_path) or os.path.getsize(output_path)!=size:
+                return None
+        return entry['record']
+
+    def make_entry(self, fingerprint, record, root, written):
+        # written lists the output files saved for the study
+        outputs={os.path.relpath(path, root): os.path.getsize(path) for path in written}
+        return dict(fingerprint, outputs=outputs, record=record)
+
+    def update(self, key, entry):
+        self.studies[key]=entry
+
+    def save(self):
+        tmp_path=self.path+'.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.version, 'studies': self.studies}, f)
+        os.replace(tmp_path, self.path)
+
+STUDY_INDEX_VERSION=1
+
+def normalize_report_text(text):
+    return re.sub(r"\s+", " ", text) if isinstance(text, str) else ""
+
+def study_index_sources(mimic_eye_path, mimic_cxr_path):
+    return [os.path.join(mimic_eye_path,'spreadsheets/cxr_meta.csv'),
+            os.path.join(mimic_eye_path,'spreadsheets/CXR-JPG/cxr_split.csv'),
+            os.path.join(mimic_cxr_path,'mimic-cxr-sections/mimic_cxr_sectioned.csv')]
+
+def list_study_paths(mimic_eye_path):
+    return sorted(os.path.relpath(p, mimic_eye_path) for p in glob(os.path.join(mimic_eye_path,'patient_*/CXR-JPG/s*')))
+
+def build_study_index(mimic_eye_path, mimic_cxr_path, study_paths=None):
+    # Join the spreadsheets once into study_id -> the few fields process_patient needs
+    meta_file, cxr_split_file, cxr_reports_file=study_index_sources(mimic_eye_path, mimic_cxr_path)
+    meta_df = pd.read_csv(meta_file, usecols=['subject_id', 'dicom_id', 'in_eye_gaze', 'in_reflacx'])
+    remove_list=[k for k,v in Counter(meta_df['subject_id'].tolist()).items() if v>1]
+    meta_df = meta_df[~meta_df['subject_id'].isin(remove_list)].set_index('subject_id')
+    cxr_split = pd.read_csv(cxr_split_file, index_col=1)['split']
+    study_paths = list_study_paths(mimic_eye_path) if study_paths is None else study_paths
     
-    # Apply colors according to intensity map
-    for y in range(height):
-        for x in range(width):
-            intensity = min(255, max(0, int(intensity_map[y][x] * 255)))
-            draw.point((x, y), fill=(255 - intensity, 0, 0, intensity))
+    studies={}
+    for study_path in study_paths:
+        patient_id=study_path.split('patient_')[-1].split('/')[0]
+        study_id=study_path.split('/')[-1]
+        if int(patient_id) not in meta_df.index:
+            continue
+        meta=meta_df.loc[int(patient_id)]
+        if meta['dicom_id'] not in cxr_split.index:
+            continue
+        studies[study_id]={'patient_id': patient_id, 'dicom_id': meta['dicom_id'], 'split': cxr_split.loc[meta['dicom_id']],
+                           'in_eye_gaze': bool(meta['in_eye_gaze']), 'in_reflacx': bool(meta['in_reflacx']),
+                           'findings': "", 'impression': ""}
     
-    return heatmap_image
+    cxr_reports = pd.read_csv(cxr_reports_file, usecols=['study', 'findings', 'impression'])
+    cxr_reports = cxr_reports[cxr_reports['study'].isin(studies.keys())].drop_duplicates(subset='study')
+    for study_id, findings, impression in cxr_reports[['study', 'findings', 'impression']].fillna('').itertuples(index=False):
+        studies[study_id]['findings']=normalize_report_text(findings)
+        studies[study_id]['impression']=normalize_report_text(impression)
+    return {'version': STUDY_INDEX_VERSION, 'remove_list': [str(i) for i in remove_list],
+            'study_paths': study_paths, 'studies': studies}
+
+def load_study_index(index_path, mimic_eye_path, mimic_cxr_path, rebuild=False):
+    # The index is rebuilt whenever one of the source spreadsheets changes on disk or
+    # study directories are added or removed; listing them is cheap next to the CSV parse
+    study_paths=list_study_paths(mimic_eye_path)
+    sources={}
+    for source in study_index_sources(mimic_eye_path, mimic_cxr_path):
+        st=os.stat(source)
+        sources[source]=[st.st_size, st.st_mtime_ns]
+    if not rebuild and os.path.exists(index_path):
+        with open(index_path, 'rb') as f:
+            index=pickle.load(f)
+        if index.get('version')==STUDY_INDEX_VERSION and index.get('sources')==sources and index.get('study_paths')==study_paths:
+            return index
+    index=build_study_index(mimic_eye_path, mimic_cxr_path, study_paths)
+    index['sources']=sources
+    tmp_path=index_path+'.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+    return index
+
+# Set once per pool worker so the study index and VQA table are inherited (fork) or
+# pickled once per worker (spawn) instead of once per task
+_worker_generator=None
 
-def extract_first_element(lst):
-    if isinstance(lst, list) and len(lst) > 0:
-        return lst[0]
-    else:
-        return None
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator=generator
+
+def _process_patients_worker(bps):
+    return list(_worker_generator.iter_studies(bps))
         
 class GazeHeatMapGenerator:
     def __init__(self, 
                  mimic_eye_path='physionet.org/files/mimic-eye',
                  mimic_cxr_path='physionet.org/files/mimic-cxr/2.0.0',
                  mimic_cxr_vqa_path='physionet.org/files/mimic-ext-mimic-cxr-vqa/1.0.0',
+                 radius=5,
+                 target_size=512,
+                 manifest_path=None,
+                 study_index_path='mimic-eye-study-index.pkl',
+                 rebuild_index=False,
+                 gaze_store_path=None,
+                 blur_backend='scipy',
+                 variants=None,
+                 profile=False,
+                 profile_hook=None,
+                 prefetch_depth=4,
+                 write_queue_depth=8,
+                 writer_threads=1,
+                 decode='full',
+                 output_format='png',
+                 quality=None,
+                 compress_level=None,
+                 write_resized=True,
                 ):
-        self.mimic_eye_path=mimic_eye_path
+        # Normalized once, so output ids do not depend on e.g. a trailing slash
+        self.mimic_eye_path=os.path.normpath(mimic_eye_path)
         self.mimic_cxr_path=mimic_cxr_path
-        mimic_eye_images_path=os.path.join(mimic_eye_path,'patient_*/CXR-JPG/s*')
-        meta_file=os.path.join(mimic_eye_path,'spreadsheets/cxr_meta.csv')
-        cxr_split_file=os.path.join(mimic_eye_path,'spreadsheets/CXR-JPG/cxr_split.csv')
-        cxr_reports_file=os.path.join(mimic_cxr_path,'mimic-cxr-sections/mimic_cxr_sectioned.csv')
-        self.meta_df = pd.read_csv(meta_file)
-        remove_list=[k for k,v in Counter(meta_df['subject_id'].tolist()).items() if v>1]
-        self.set_index('subject_id', inplace=True)
-        self.remove_list=[str(i) for i in remove_list]
-        self.meta_df.drop(index=remove_list, inplace=True)
-        self.patient_subjects = glob('files/mimic-eye/patient_*/CXR-JPG/s*')
-        self.cxr_reports = pd.read_csv(cxr_reports_file)
-        self.cxr_reports.fillna('', inplace=True)
-        self.cxr_reports.set_index('study', inplace=True)
-        self.cxr_split = pd.read_csv(cxr_split_file, index_col=1)
-        
-        with open(os.path.join(mimic_cxr_vqa_path,'train.json'), 'r') as file:
-            train = json.load(file)
-        with open(os.path.join(mimic_cxr_vqa_path,'valid.json'), 'r') as file:
-            valid = json.load(file)
-        with open(os.path.join(mimic_cxr_vqa_path,'test.json'), 'r') as file:
-            test = json.load(file)
-        data=train+valid+test
-        vqadf=pd.DataFrame(data)
-        vqadf=vqadf[['image_path','answer','question']]
-        vqadf=vqadf[vqadf['answer'].apply(len) > 0]
-        self.vqadf=vqadf
-
-    def process_patient(self, bp):
+        self.variants=resolve_variants(variants, radius=radius, target_size=target_size, blur_backend=blur_backend)
+        self.manifest=BuildManifest(manifest_path) if manifest_path else None
+        self.gaze_store=GazeStore(gaze_store_path) if gaze_store_path else None
+        # profile_hook(study_id) returns a context manager wrapped around each study,
+        # e.g. partial(cprofile_hook, output_dir) or a sampling profiler
+        self.profile=profile
+        self.profile_hook=profile_hook
+        # Studies read ahead of the one being rendered, and images queued for saving
+        self.prefetch_depth=prefetch_depth
+        self.write_queue_depth=write_queue_depth
+        self.writer_threads=writer_threads
+        # 'draft' lets libjpeg decode at the smallest 1/2, 1/4 or 1/8 scale that still
+        # covers the largest target size. write_resized=False keeps image_id in the
+        # records (it is the VQA join key) but only writes the heat maps
+        if decode not in DECODE_MODES:
+            raise ValueError(f'unknown decode mode {decode!r}, expected one of {DECODE_MODES}')
+        self.decode=decode
+        self.output_format=output_format
+        self.save_params=save_params(output_format, quality, compress_level)
+        self.write_resized=write_resized
+        study_index=load_study_index(study_index_path, self.mimic_eye_path, mimic_cxr_path, rebuild=rebuild_index)
+        self.studies=study_index['studies']
+        self.remove_list=set(study_index['remove_list'])
+        self.patient_subjects = [os.path.join(self.mimic_eye_path, p) for p in study_index['study_paths']]
+        self.vqadf=load_vqa(mimic_cxr_vqa_path, self.image_ids())
+
+    def image_ids(self):
+        # VQA join key of every indexed study, see vqa_image_path
+        return {f"/patient_{study['patient_id']}/CXR-JPG/{study_id}/{study['dicom_id']}{VQA_IMAGE_SUFFIX}" for study_id, study in self.studies.items()}
+
+    def output_id(self, path):
+        # '/patient_.../...' id of a file under mimic_eye_path, as used in the records
+        return '/'+os.path.relpath(path, self.mimic_eye_path)
+
+    def load_fixations(self, patient_id, study_id, EG, profile=NULL_PROFILE):
+        # Zero-copy slices from the gaze store when it is current for this study,
+        # otherwise parse fixations.csv
+        if self.gaze_store is not None:
+            fixations=self.gaze_store.get(study_id, self.mimic_eye_path)
+            if fixations is not None:
+                profile.read(nbytes=sum(column.nbytes for column in fixations.values()))
+                return fixations
+        path, fixations=read_fixations(self.mimic_eye_path, patient_id, EG)
+        profile.read(os.path.join(self.mimic_eye_path, path))
+        return fixations
+
+    def read_study(self, bp, profile=NULL_PROFILE):
+        # Blocking reads of a study: the decoded CXR, its fixations and, for eye gaze
+        # studies, the master sheet row. Returns None for patients in remove_list
         patient_id=bp.split('/patient_')[-1].split('/')[0]      
         if patient_id in self.remove_list:
             return None
         study_id=bp.split('/')[-1]
-        dicom_id=self.meta_df.loc[int(patient_id)]['dicom_id']
-        split=self.cxr_split.loc[dicom_id]['split']
-        EG=self.meta_df.loc[int(patient_id)]['in_eye_gaze']
-        REFLACX=self.meta_df.loc[int(patient_id)]['in_reflacx']
-        
-        try:
-            findings=self.cxr_reports.loc[study_id]['findings']
-            findings = re.sub("\s+", " ", findings)
-        except:
-            findings = ""
-        try:
-            impression=self.cxr_reports.loc[study_id]['impression']
-            impression = re.sub("\s+", " ", impression)
-        except:
-            impression=""
+        study=self.studies[study_id]
+        image_path=os.path.join(self.mimic_eye_path,f"patient_{patient_id}/CXR-JPG/{study_id}/{study['dicom_id']}.jpg")
+        with profile.stage('image_decode'):
+            image = Image.open(image_path)
+            size=image.size
+            if self.decode=='draft':
+                image.draft(image.mode, long_side_size(*size, max(v['target_size'] for v in self.variants)))
+            image.load()
+        profile.read(image_path)
+        with profile.stage('gaze_load'):
+            fixations=self.load_fixations(patient_id, study_id, study['in_eye_gaze'], profile)
+        master_sheet=None
+        if study['in_eye_gaze']:
+            master_sheet_path=os.path.join(self.mimic_eye_path,f'patient_{patient_id}/EyeGaze/master_sheet.csv')
+            with profile.stage('master_sheet'):
+                master_sheet=pd.read_csv(master_sheet_path).loc[0]
+            profile.read(master_sheet_path)
+        return {'image_path': image_path, 'image': image, 'size': size, 'fixations': fixations, 'master_sheet': master_sheet}
+
+    def process_patient(self, bp, profile=NULL_PROFILE, inputs=None, writer=None):
+        # inputs come from read_study, e.g. read ahead on a prefetch thread; images are
+        # saved through writer, synchronously when it is None
+        if inputs is None:
+            inputs=self.read_study(bp, profile)
+            if inputs is None:
+                return None
+        profile.mark_rendered()
+        writer=writer or BackgroundWriter(depth=0)
+        study=self.studies[bp.split('/')[-1]]
+        split=study['split']
+        EG=study['in_eye_gaze']
+        findings=study['findings']
+        impression=study['impression']
             
-        image_path=os.path.join(self.mimic_eye_path,f'/patient_{patient_id}/CXR-JPG/{study_id}/{dicom_id}.jpg')
-        image = Image.open(image_path)
-        width, height=image.size
-        if width>height:
-            newheight=int(float(height)/float(width)*512.0)
-            image512 = image.resize((512, newheight))
-        else:
-            newwidth=int(float(width)/float(height)*512.0)
-            image512 = image.resize((newwidth, 512))
-        resized_image_path=image_path.replace('.jpg','_512.png')
-        image512.save(resized_image_path)
-        width512, height512=image512.size
+        image_path=inputs['image_path']
+        image=inputs['image']
+        width, height=inputs['size']
+        ext=OUTPUT_FORMATS[self.output_format]
+        # Decode once and resize once per distinct target size
+        resized_images={}
+        for variant in self.variants:
+            target_size=variant['target_size']
+            if target_size not in resized_images:
+                with profile.stage('image_resize'):
+                    image512=resize_long_side(image, target_size, (width, height))
+                resized_image_path=image_path.replace('.jpg',f'_{target_size}{ext}')
+                resized_images[target_size]=(image512.convert('RGBA'), resized_image_path)
+                if self.write_resized:
+                    writer.save(image512, resized_image_path, profile, 'png_encode_resized', **self.save_params)
+                else:
+                    image512.close()
         image.close()
         
+        fixations=inputs['fixations']
+        x, y=fixations['x'], fixations['y']
+        inside=(x>0)&(y>0)&(x<width)&(y<height)
+        x, y=x[inside], y[inside]
+        durations={None: fixations['duration'][inside]}
+        
+        # Variants share intensity maps whenever size, radius and time window agree
+        intensity_maps={}
+        blurred_maps={}
+        outputs={}
+        for i, variant in enumerate(self.variants):
+            image512, resized_image_path=resized_images[variant['target_size']]
+            width512, height512=image512.size
+            radius=variant['radius']
+            time_window=tuple(variant['time_window']) if variant['time_window'] is not None else None
+            key=(variant['target_size'], radius, time_window)
+            with profile.stage('intensity'):
+                if time_window not in durations:
+                    durations[time_window]=window_durations(fixations['timestamp_start_fixation'][inside], fixations['timestamp_end_fixation'][inside], time_window)
+                if key not in intensity_maps:
+                    intensity_maps[key]=accumulate_intensity(x*(width512/width), y*(height512/height), durations[time_window], width512, height512, radius)
+            blur_key=key+(variant['blur_backend'],)
+            with profile.stage('blur'):
+                if blur_key not in blurred_maps:
+                    blurred_maps[blur_key]=normalize_intensity(gaussian_blur(intensity_maps[key], radius, variant['blur_backend']))
+            with profile.stage('colorize_composite'):
+                full_heatmap_image=Image.fromarray(COLORMAPS[variant['colormap']](blurred_maps[blur_key]), 'RGBA')
+                full_result_image = Image.alpha_composite(image512, full_heatmap_image)
+            full_heatmap_image_path=image_path.replace('.jpg',f'_heatmap{ext}' if i==0 else f"_heatmap_{variant['name']}{ext}")
+            writer.save(full_result_image, full_heatmap_image_path, profile, 'png_encode_heatmap', **self.save_params)
+            outputs[variant['name']]={'image_id': self.output_id(resized_image_path),
+                                      'heatmap_image_id': self.output_id(full_heatmap_image_path)}
+        
         if EG:
-            gaze_data=pd.read_csv(os.path.join(self.mimic_eye_path,f'/patient_{patient_id}/EyeGaze/fixations.csv'))
-            initial_value=gaze_data['Time (in secs)'].iloc[0]
-            gaze_data['timestamp_start_fixation']=gaze_data['Time (in secs)'].shift().fillna(0.0)
-            gaze_data['timestamp_end_fixation']=gaze_data['Time (in secs)']
-            gaze_data['Time (in secs)']=gaze_data['Time (in secs)'].diff().fillna(initial_value)
-            gaze_data=gaze_data[(gaze_data['X_ORIGINAL']>0)&(gaze_data['Y_ORIGINAL']>0)&(gaze_data['X_ORIGINAL']<width)&(gaze_data['Y_ORIGINAL']<height)]
-            gaze_data=gaze_data[['Time (in secs)','X_ORIGINAL', 'Y_ORIGINAL','transcript']]
-            full_heatmap_image=generate_heatmap(image512.convert('RGBA'), width512, height512, width512/width, height512/height, gaze_data, _x='X_ORIGINAL', _y='Y_ORIGINAL')
-
-            m=pd.read_csv(os.path.join(self.mimic_eye_path,f'/patient_{patient_id}/EyeGaze/master_sheet.csv'))
-            m=pd.read_csv(bp.replace('bounding_boxes', 'master_sheet')).loc[0]
+            m=inputs['master_sheet']
             temp_dict=m[['gender', 'anchor_age', 'cxr_exam_indication']].fillna('').to_dict()
             ddx="Here is the list of possible diseases for the given chest X-ray:\n"
         
@@ -139,71 +484,168 @@ class GazeHeatMapGenerator:
                 ddx+=f'{k[-1]}. {v}.\n'
     
         else:
-            for i in os.listdir(os.path.join(self.mimic_eye_path,f'patient_{patient_id}/REFLACX/main_data/')):
-                try:
-                    gaze_data=pd.read_csv(os.path.join(self.mimic_eye_path,f'patient_{patient_id}/REFLACX/main_data/{i}/fixations.csv'))
-                except:
-                    gaze_data=None
-                if gaze_data is not None:
-                    break
-            gaze_data=gaze_data[(gaze_data['x_position']>0)&(gaze_data['y_position']>0)&(gaze_data['x_position']<width)&(gaze_data['y_position']<height)]
-            gaze_data['Time (in secs)']=gaze_data['timestamp_end_fixation']-gaze_data['timestamp_start_fixation']
-            gaze_data=gaze_data[['Time (in secs)','x_position', 'y_position','transcript']]
-            full_heatmap_image=generate_heatmap(image512.convert('RGBA'), width512, height512, width512/width, height512/height, gaze_data, _x='x_position', _y='y_position')
             ddx=""
-            
-        full_result_image = Image.alpha_composite(image512.convert('RGBA'), full_heatmap_image)
-        full_heatmap_image_path=image_path.replace('.jpg','_heatmap.png')
-        full_result_image.save(full_heatmap_image_path)
-        image512.close()
-        full_result_image.close()
     
         temp_dict={}
-        temp_dict['image_id']=resized_image_path.replace(self.mimic_eye_path, '')
-        temp_dict['heatmap_image_id']=full_heatmap_image_path.replace(self.mimic_eye_path, '')
+        temp_dict.update(outputs[self.variants[0]['name']])
         temp_dict['findings']=findings
+        # The GEN/SUM builders in prompt_processing.py and instruction_tuning_processing.py
+        # read the unmodified report as findings_org
+        temp_dict['findings_org']=findings
         temp_dict['impression']=impression
         temp_dict['differential_diagnosis']=ddx
         temp_dict['split']=split
         temp_dict['source']='EG' if EG else 'REFLACX'
+        if len(self.variants)>1:
+            temp_dict['variants']=outputs
         return temp_dict
 
-    def process_all(self):
-        data_dict=[]
-        train_data_dict=[]
-        val_test_data_dict=[]
-        
-        for bp in tqdm(self.patient_subjects, total=len(self.patient_subjects)):
-            temp_dict=self.process_patient(bp)
-            if temp_dict is None:
-                continue
-            data_dict.append(temp_dict)
-            if temp_dict['source']=='REFLACX':
-                train_data_dict.append(temp_dict)
-            else:
-                val_test_data_dict.append(temp_dict)
+    def study_fingerprint(self, bp):
+        patient_id=bp.split('/patient_')[-1].split('/')[0]
+        if patient_id in self.remove_list:
+            return None
+        study_id=bp.split('/')[-1]
+        previous=self.manifest.previous_inputs(os.path.relpath(bp, self.mimic_eye_path))
+        study=self.studies[study_id]
+        dicom_id=study['dicom_id']
+        EG=study['in_eye_gaze']
+        rows=json.dumps(study, sort_keys=True)
         
-        train_df=pd.DataFrame(train_data_dict)
-        train_df.set_index('image_id', inplace=True)
-        vqadf=self.vqadf.copy()
-        vqadf.set_index('image_path', inplace=True)
-        merged_df=pd.merge(train_df, vqa_df, left_index=True, right_index=True)[['answer','question']]
-        merged_df['answer'] = merged_df['answer'].apply(extract_first_element)
-        train_data_dict=merged_df.reset_index().to_dict(orient='records')
-        with open('mimic-eye-heat-train.json', 'w') as fi:
-            fi.write(json.dumps(train_data_dict))
+        inputs=[f'patient_{patient_id}/CXR-JPG/{study_id}/{dicom_id}.jpg']
+        if EG:
+            inputs+=[f'patient_{patient_id}/EyeGaze/fixations.csv', f'patient_{patient_id}/EyeGaze/master_sheet.csv']
+        else:
+            inputs+=sorted(os.path.relpath(p, self.mimic_eye_path) for p in glob(os.path.join(self.mimic_eye_path, f'patient_{patient_id}/REFLACX/main_data/*/fixations.csv')))
+        return {'params': {'variants': self.variants, 'decode': self.decode, 'output_format': self.output_format,
+                           'save_params': self.save_params, 'write_resized': self.write_resized},
+                'rows': hashlib.sha1(rows.encode()).hexdigest(),
+                'inputs': {i: file_digest(os.path.join(self.mimic_eye_path, i), previous.get(i)) for i in inputs}}
+
+    def load_study(self, bp):
+        # Read stage of a study, run on prefetch threads: the manifest check, then
+        # read_study unless the stored record is still valid
+        profile=StudyProfile(bp.split('/')[-1]) if self.profile else NULL_PROFILE
+        loaded={'profile': profile, 'fingerprint': None, 'record': None, 'inputs': None}
+        if self.manifest is not None:
+            with profile.stage('manifest_check'):
+                loaded['fingerprint']=self.study_fingerprint(bp)
+                if loaded['fingerprint'] is None:
+                    return loaded
+                loaded['record']=self.manifest.lookup(os.path.relpath(bp, self.mimic_eye_path), loaded['fingerprint'], self.mimic_eye_path)
+            if loaded['record'] is not None:
+                loaded['fingerprint']=None
+                return loaded
+        loaded['inputs']=self.read_study(bp, profile)
+        return loaded
+
+    def start_study(self, bp, loaded, writer):
+        # Render stage of a study whose load_study future is `loaded`; its images are
+        # queued on writer. Returns the arguments of finish_study
+        profile=NULL_PROFILE
+        try:
+            loaded=loaded.result()
+            profile=loaded['profile']
+            if loaded['inputs'] is None:
+                return bp, loaded['record'], None, [], profile, None
+            with self.profile_hook(bp.split('/')[-1]) if self.profile_hook else nullcontext():
+                temp_dict=self.process_patient(bp, profile, loaded['inputs'], writer)
+            return bp, temp_dict, loaded['fingerprint'], writer.take(), profile, None
+        except Exception as e:
+            return bp, None, None, writer.take(), profile, f'{type(e).__name__}: {e}'
+
+    def finish_study(self, bp, temp_dict, fingerprint, writes, profile, error):
+        # Wait for the study's images, then return (bp, temp_dict, error, manifest_entry, profile)
+        written=[]
+        for future in writes:
+            try:
+                written.append(future.result())
+            except Exception as e:
+                error=error or f'{type(e).__name__}: {e}'
+        if error is not None:
+            return bp, None, error, None, None
+        try:
+            entry=self.manifest.make_entry(fingerprint, temp_dict, self.mimic_eye_path, written) if fingerprint is not None else None
+        except Exception as e:
+            return bp, None, f'{type(e).__name__}: {e}', None, None
+        return bp, temp_dict, None, entry, profile.as_dict() if self.profile else None
+
+    def iter_studies(self, bps, prefetch_depth=None, write_queue_depth=None):
+        # finish_study results in bps order. The next prefetch_depth studies are read
+        # while the current one renders and up to write_queue_depth images are saved
+        # in the background; studies are finished once all their images are written
+        prefetch_depth=self.prefetch_depth if prefetch_depth is None else prefetch_depth
+        write_queue_depth=self.write_queue_depth if write_queue_depth is None else write_queue_depth
+        with BackgroundWriter(write_queue_depth, self.writer_threads) as writer:
+            pending=deque()
+            for bp, loaded in prefetch(self.load_study, bps, prefetch_depth):
+                pending.append(self.start_study(bp, loaded, writer))
+                while pending and all(future.done() for future in pending[0][3]):
+                    yield self.finish_study(*pending.popleft())
+            while pending:
+                yield self.finish_study(*pending.popleft())
+
+    def iter_patients(self, workers=1, chunksize=4):
+        # Yields finish_study results, (bp, temp_dict, error, manifest_entry, profile), in
+        # patient_subjects order for any worker count; each worker pipelines I/O over a
+        # chunk of consecutive studies
+        if workers<=1:
+            yield from self.iter_studies(self.patient_subjects)
+            return
+        chunks=[self.patient_subjects[i:i+chunksize] for i in range(0, len(self.patient_subjects), chunksize)]
+        ctx=mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else None)
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            for results in pool.imap(_process_patients_worker, chunks):
+                yield from results
+
+    def iter_records(self, workers=1, checkpoint_every=100):
+        # Yields rendered study records in order, collecting failures and updating the manifest
+        self.failures=[]
+        self.profiles=[]
+        try:
+            for n, (bp, temp_dict, error, entry, profile) in enumerate(tqdm(self.iter_patients(workers), total=len(self.patient_subjects))):
+                if entry is not None:
+                    self.manifest.update(os.path.relpath(bp, self.mimic_eye_path), entry)
+                    if n%checkpoint_every==0:
+                        self.manifest.save()
+                if profile is not None:
+                    self.profiles.append(profile)
+                if error is not None:
+                    self.failures.append({'study_path': bp, 'error': error})
+                    continue
+                if temp_dict is not None:
+                    yield temp_dict
+        finally:
+            # Keep finished studies on interruption so the next run resumes from here
+            if self.manifest is not None:
+                self.manifest.save()
+
+    def process_all(self, workers=1, checkpoint_every=100, train_path='mimic-eye-heat-train.jsonl', test_path='mimic-eye-heat-test.jsonl', profile_output='mimic-eye-heat-profile'):
+        # REFLACX studies are joined with every VQA question for training, eye gaze
+        # studies with their first yes/no question for testing
+        train_vqa=vqa_lookup(self.vqadf)
+        test_vqa=vqa_lookup(yes_no_questions(self.vqadf))
         
-        test_df=pd.DataFrame(val_test_data_dict)
-        test_df.set_index('image_id', inplace=True)
-        vqadf = vqadf[vqadf['answer'].apply(lambda x: x == ['yes'] or x == ['no'])]
-        vqadf.drop_duplicates(subset='image_path', inplace=True)
-        vqadf.set_index('image_path', inplace=True)
-        merged_df=pd.merge(test_df, vqa_df, left_index=True, right_index=True)[['answer','question']]
-        merged_df['answer'] = merged_df['answer'].apply(extract_first_element)
-        val_test_data_dict=merged_df.reset_index().to_dict(orient='records')
-
-        with open('mimic-eye-heat-test.json', 'w') as fi:
-            fi.write(json.dumps(val_test_data_dict))
+        records, rows=0, 0
+        with open(train_path, 'w') as train_fi, open(test_path, 'w') as test_fi:
+            for temp_dict in self.iter_records(workers, checkpoint_every):
+                if temp_dict['source']=='REFLACX':
+                    fi, vqa=train_fi, train_vqa
+                else:
+                    fi, vqa=test_fi, test_vqa
+                records+=1
+                for qa in vqa.get(vqa_image_path(temp_dict['image_id']), []):
+                    fi.write(json.dumps({**temp_dict, **qa})+"\n")
+                    rows+=1
+        if records and not rows:
+            print(f'warning: none of the {records} rendered studies matched a VQA question, {train_path} and {test_path} are empty')
+
+        if self.profiles:
+            write_profiles(self.profiles, profile_output)
+            print(f'per-study profile written to {profile_output}.csv, summary to {profile_output}.json')
+        if self.failures:
+            print(f'{len(self.failures)} studies failed, see mimic-eye-heat-failures.json')
+            with open('mimic-eye-heat-failures.json', 'w') as fi:
+                fi.write(json.dumps(self.failures, indent=1))
 
 if __name__ == '__main__':
     import argparse
@@ -211,9 +653,58 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--mimic-eye-path", type=str, default='physionet.org/files/mimic-eye')
     parser.add_argument("--mimic-cxr-path", type=str, default='physionet.org/files/mimic-cxr/2.0.0')
+    parser.add_argument("--mimic-cxr-vqa-path", type=str, default='physionet.org/files/mimic-ext-mimic-cxr-vqa/1.0.0')
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes for rendering studies")
+    parser.add_argument("--radius", type=int, default=5)
+    parser.add_argument("--target-size", type=int, default=512)
+    parser.add_argument("--blur-backend", type=str, default='scipy', choices=sorted(BLUR_BACKENDS), help="scipy is the reference; stamp and separable are faster and agree up to rounding")
+    parser.add_argument("--variants-file", type=str, default=None, help="JSON list of render variants, e.g. [{\"name\": \"r10\", \"radius\": 10}]")
+    parser.add_argument("--profile", action='store_true', help="record per-stage wall time and bytes read/written for every study, and the peak RSS of each process")
+    parser.add_argument("--profile-output", type=str, default='mimic-eye-heat-profile', help="prefix of the profile .csv/.json files")
+    parser.add_argument("--cprofile-dir", type=str, default=None, help="write a cProfile dump per study to this directory")
+    parser.add_argument("--variant", type=str, action='append', default=[], help="extra render variant as name:key=value,..., e.g. early:time_window=0-5,colormap=jet")
+    parser.add_argument("--incremental", action='store_true', help="skip studies whose outputs are up to date in the manifest")
+    parser.add_argument("--manifest", type=str, default='mimic-eye-heat-manifest.json')
+    parser.add_argument("--study-index", type=str, default='mimic-eye-study-index.pkl')
+    parser.add_argument("--rebuild-index", action='store_true', help="rebuild the study index even if the spreadsheets are unchanged")
+    parser.add_argument("--prefetch-depth", type=int, default=4, help="studies whose images and gaze files are read ahead on threads while one renders; 0 reads inline")
+    parser.add_argument("--write-queue-depth", type=int, default=8, help="output images queued for background saving before rendering waits; 0 saves inline")
+    parser.add_argument("--writer-threads", type=int, default=1)
+    parser.add_argument("--decode", type=str, default='full', choices=DECODE_MODES, help="draft decodes the JPEG at a reduced scale before resizing; faster, not bit-identical")
+    parser.add_argument("--output-format", type=str, default='png', choices=sorted(OUTPUT_FORMATS), help="npy writes raw uint8 arrays")
+    parser.add_argument("--quality", type=int, default=None, help="webp/jpeg quality")
+    parser.add_argument("--compress-level", type=int, default=None, help="png zlib level, 0-9")
+    parser.add_argument("--skip-resized", action='store_true', help="only write the heat map overlays, not the resized images")
+    parser.add_argument("--gaze-store", type=str, default=None, help="gaze store written by gaze_store.py; fixations.csv is parsed when omitted")
     args = parser.parse_args()
 
-    gvg=GazeVideoGenerator(mimic_eye_path=args.mimic_eye_path,
-                           mimic_cxr_path=args.mimic_cxr_path
-                          )
-    gvg.process_all()
+    # --variant entries are added after the variants file, or after the default variant
+    variants=[{}]
+    if args.variants_file:
+        with open(args.variants_file) as f:
+            variants=json.load(f)
+    variants+=[parse_variant(spec) for spec in args.variant]
+
+    ghg=GazeHeatMapGenerator(mimic_eye_path=args.mimic_eye_path,
+                             mimic_cxr_path=args.mimic_cxr_path,
+                             mimic_cxr_vqa_path=args.mimic_cxr_vqa_path,
+                             radius=args.radius,
+                             target_size=args.target_size,
+                             blur_backend=args.blur_backend,
+                             manifest_path=args.manifest if args.incremental else None,
+                             study_index_path=args.study_index,
+                             rebuild_index=args.rebuild_index,
+                             gaze_store_path=args.gaze_store,
+                             variants=variants,
+                             profile=args.profile,
+                             profile_hook=partial(cprofile_hook, args.cprofile_dir) if args.cprofile_dir else None,
+                             prefetch_depth=args.prefetch_depth,
+                             write_queue_depth=args.write_queue_depth,
+                             writer_threads=args.writer_threads,
+                             decode=args.decode,
+                             output_format=args.output_format,
+                             quality=args.quality,
+                             compress_level=args.compress_level,
+                             write_resized=not args.skip_resized
+                            )
+    ghg.process_all(workers=args.workers, profile_output=args.profile_output)
@@ -0,0 +1,132 @@
+import numpy as np
+from gaussian_blur import gaussian_blur
+
+# Array-level heat map rendering shared by the dataset builder and the batch API
+# below. Nothing here touches the filesystem or PIL, so render_batch can run
+# inside dataloader workers to draw overlays on the fly instead of reading the
+# pre-rendered _heatmap.png files.
+
+def accumulate_intensity(x, y, duration, width, height, radius=5):
+    # Scatter-add fixation durations into a (height, width) intensity map
+    x=np.asarray(x, dtype=float).astype(int)
+    y=np.asarray(y, dtype=float).astype(int)
+    duration=np.asarray(duration, dtype=float)
+    intensity_map = np.zeros((height, width))
+    inside=(y<height-radius)&(y>=radius)&(x>=radius)&(x<width-radius)
+    np.add.at(intensity_map, (y[inside], x[inside]), duration[inside])
+    return intensity_map
+
+def normalize_intensity(intensity_map):
+    # Normalize each map by its own peak, leaving empty maps at zero
+    peak=intensity_map.max(axis=(-2, -1), keepdims=True)
+    return np.divide(intensity_map, peak, out=np.zeros_like(intensity_map), where=peak>0)
+
+def intensity_to_rgba(intensity_map):
+    # Red channel fades and alpha grows with intensity, as (255 - i, 0, 0, i)
+    intensity=np.clip((intensity_map*255).astype(np.int64), 0, 255).astype(np.uint8)
+    rgba=np.zeros(intensity.shape+(4,), dtype=np.uint8)
+    rgba[..., 0]=255-intensity
+    rgba[..., 3]=intensity
+    return rgba
+
+def intensity_to_rgba_jet(intensity_map):
+    # Blue to red jet ramp, with the same alpha ramp as intensity_to_rgba
+    intensity=np.clip((intensity_map*255).astype(np.int64), 0, 255).astype(np.uint8)
+    level=intensity/255.0
+    rgba=np.empty(intensity.shape+(4,), dtype=np.uint8)
+    for channel, center in enumerate([3, 2, 1]):
+        rgba[..., channel]=(np.clip(1.5-np.abs(4*level-center), 0, 1)*255).astype(np.uint8)
+    rgba[..., 3]=intensity
+    return rgba
+
+COLORMAPS={'red': intensity_to_rgba, 'jet': intensity_to_rgba_jet}
+
+def window_durations(start, end, time_window):
+    # Time each fixation overlaps [t0, t1), in seconds
+    t0, t1=time_window
+    return np.clip(np.minimum(end, t1)-np.maximum(start, t0), 0, None)
+
+def long_side_size(width, height, target_size):
+    if width>height:
+        return target_size, int(float(height)/float(width)*float(target_size))
+    else:
+        return int(float(width)/float(height)*float(target_size)), target_size
+
+def alpha_composite(base, overlay):
+    # Image.alpha_composite on (..., 4) uint8 arrays, with PIL's fixed-point rounding
+    src=overlay.astype(np.int64)
+    dst=base.astype(np.int64)
+    src_a, dst_a=src[..., 3:], dst[..., 3:]
+    outa255=src_a*255+dst_a*(255-src_a)
+    coef1=src_a*255*255*128//np.maximum(outa255, 1)
+    coef2=255*128-coef1
+    tmp=src[..., :3]*coef1+dst[..., :3]*coef2+(0x80<<7)
+    rgb=(((tmp>>8)+tmp)>>8)>>7
+    tmp=outa255+0x80
+    out=np.concatenate([rgb, ((tmp>>8)+tmp)>>8], axis=-1)
+    # Fully transparent results keep the base pixel, as in PIL
+    return np.where(outa255==0, dst, out).astype(np.uint8)
+
+def to_rgba(image):
+    # Grayscale, RGB or RGBA uint8 pixels as RGBA, like Image.convert('RGBA')
+    image=np.asarray(image, dtype=np.uint8)
+    if image.ndim==2:
+        image=np.repeat(image[..., None], 3, axis=-1)
+    if image.shape[-1]==3:
+        image=np.concatenate([image, np.full(image.shape[:-1]+(1,), 255, dtype=np.uint8)], axis=-1)
+    return image
+
+def fixation_columns(fixations):
+    # x, y and duration of a dict as returned by GazeStore.get or read_fixations, or
+    # of an (n, 3) array, in original image pixels
+    if isinstance(fixations, dict):
+        return tuple(np.asarray(fixations[c], dtype=float) for c in ['x', 'y', 'duration'])
+    fixations=np.asarray(fixations, dtype=float).reshape(-1, 3)
+    return fixations[:, 0], fixations[:, 1], fixations[:, 2]
+
+def render_batch(fixations, image_sizes, target_sizes=512, radius=5, blur_backend='separable', colormap='red',
+                 base_images=None, jitter=0.0, radius_range=None, rng=None):
+    # Render the heat maps of a batch of studies as arrays.
+    # fixations[i] is in the pixels of an original image of image_sizes[i] (width, height).
+    # target_sizes is a long side (int), one (width, height) tuple for the whole batch, or
+    # a list with one of either per study. Maps are padded with zeros to the largest
+    # target size of the batch; 'size' holds the (width, height) each one fills.
+    # base_images, if given, are uint8 grayscale/RGB/RGBA images at the target sizes that
+    # the overlays are alpha composited onto, as in the _heatmap.png files.
+    # For augmentation, jitter adds Gaussian noise with this std (in target pixels) to every
+    # fixation and radius_range=(low, high) draws each study's radius uniformly from
+    # low..high. With the scipy blur backend and no augmentation the overlays are
+    # identical to the rendered files.
+    rng=np.random.default_rng(rng)
+    n=len(fixations)
+    if not isinstance(target_sizes, list):
+        target_sizes=[target_sizes]*n
+    sizes=np.array([long_side_size(width, height, target_size) if np.isscalar(target_size) else target_size
+                    for (width, height), target_size in zip(image_sizes, target_sizes)], dtype=int).reshape(n, 2)
+    radii=rng.integers(radius_range[0], radius_range[1]+1, n) if radius_range is not None else np.full(n, radius)
+
+    # Studies sharing a target size and radius are blurred together as one stack
+    groups={}
+    for i, (points, (width, height)) in enumerate(zip(fixations, image_sizes)):
+        x, y, duration=fixation_columns(points)
+        inside=(x>0)&(y>0)&(x<width)&(y<height)
+        target_width, target_height=sizes[i]
+        x=x[inside]*(target_width/width)
+        y=y[inside]*(target_height/height)
+        if jitter:
+            x=x+rng.normal(0, jitter, len(x))
+            y=y+rng.normal(0, jitter, len(y))
+        key=(int(target_width), int(target_height), int(radii[i]))
+        groups.setdefault(key, []).append((i, accumulate_intensity(x, y, duration[inside], *key)))
+
+    width, height=sizes.max(axis=0) if n else (0, 0)
+    intensity=np.zeros((n, height, width), dtype=np.float32)
+    overlay=np.zeros((n, height, width, 4), dtype=np.uint8)
+    for (target_width, target_height, group_radius), group in groups.items():
+        maps=normalize_intensity(gaussian_blur(np.stack([m for _, m in group]), group_radius, blur_backend))
+        for (i, _), intensity_map, rgba in zip(group, maps, COLORMAPS[colormap](maps)):
+            intensity[i, :target_height, :target_width]=intensity_map
+            if base_images is not None:
+                rgba=alpha_composite(to_rgba(base_images[i])[:target_height, :target_width], rgba)
+            overlay[i, :target_height, :target_width]=rgba
+    return {'intensity': intensity, 'overlay': overlay, 'size': sizes, 'radius': radii}
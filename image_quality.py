@@ -0,0 +1,138 @@
+import os
+import copy
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+
+from io_pipeline import BackgroundWriter
+from heatmap_dataset_processing import DECODE_MODES, OUTPUT_FORMATS, GazeHeatMapGenerator, save_params
+
+# Renders studies with the reference settings (full decode, PNG) and with faster
+# decode/encode settings, and reports how far the candidate outputs are from the
+# reference and how much time and space they save, e.g.
+#   python image_quality.py --decode draft --output-format webp --quality 90
+
+def load_pixels(path):
+    # uint8 pixels of an output written by save_image
+    if path.endswith('.npy'):
+        return np.load(path)
+    with Image.open(path) as image:
+        return np.asarray(image)
+
+def image_metrics(reference, candidate):
+    # Compared over the candidate's channels: RGB JPEG heat maps against the RGB part
+    # of the (opaque) RGBA reference, RGB WebP images against the grayscale reference
+    if reference.shape[:2]!=candidate.shape[:2]:
+        raise ValueError(f'size mismatch {reference.shape} vs {candidate.shape}')
+    reference=reference.reshape(reference.shape[:2]+(-1,))
+    candidate=candidate.reshape(candidate.shape[:2]+(-1,))
+    reference=reference[..., :candidate.shape[-1]]
+    diff=np.abs(reference.astype(np.int16)-candidate.astype(np.int16))
+    return {'sq_err': float(np.square(diff, dtype=np.float64).sum()), 'pixels': diff.size,
+            'max_abs_diff': int(diff.max()), 'abs_err': float(diff.sum(dtype=np.float64))}
+
+class CaptureWriter(BackgroundWriter):
+    # Saves a study's outputs into a scratch directory instead of next to the CXR
+    # and keeps their decoded pixels and sizes, keyed by file name without extension
+    def __init__(self, directory):
+        super().__init__(depth=0)
+        self.directory=directory
+        self.outputs={}
+
+    def _save(self, image, path, profile, stage, params):
+        scratch_path=super()._save(image, os.path.join(self.directory, os.path.basename(path)), profile, stage, params)
+        self.outputs[os.path.splitext(os.path.basename(path))[0]]={'pixels': load_pixels(scratch_path), 'bytes': os.path.getsize(scratch_path)}
+        os.remove(scratch_path)
+        return path
+
+def render(generator, bp, directory):
+    # Seconds to render one study and its captured outputs
+    writer=CaptureWriter(directory)
+    start=time.perf_counter()
+    generator.process_patient(bp, writer=writer)
+    return time.perf_counter()-start, writer.outputs
+
+def compare_settings(reference, candidate, bps):
+    # Per output kind (e.g. 512, heatmap): PSNR, mean and max absolute difference
+    # and the size ratio of candidate vs reference outputs, plus the render time ratio
+    directory=tempfile.mkdtemp(prefix='mimic-eye-quality-')
+    totals={}
+    seconds={'reference': 0.0, 'candidate': 0.0}
+    try:
+        for bp in bps:
+            reference_s, reference_outputs=render(reference, bp, directory)
+            candidate_s, candidate_outputs=render(candidate, bp, directory)
+            seconds['reference']+=reference_s
+            seconds['candidate']+=candidate_s
+            prefix=reference.studies[bp.split('/')[-1]]['dicom_id']+'_'
+            for name, output in candidate_outputs.items():
+                total=totals.setdefault(name[len(prefix):], {'images': 0, 'sq_err': 0.0, 'pixels': 0, 'max_abs_diff': 0, 'abs_err': 0.0, 'bytes': 0, 'reference_bytes': 0})
+                metrics=image_metrics(reference_outputs[name]['pixels'], output['pixels'])
+                total['images']+=1
+                total['sq_err']+=metrics['sq_err']
+                total['pixels']+=metrics['pixels']
+                total['abs_err']+=metrics['abs_err']
+                total['max_abs_diff']=max(total['max_abs_diff'], metrics['max_abs_diff'])
+                total['bytes']+=output['bytes']
+                total['reference_bytes']+=reference_outputs[name]['bytes']
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    report={'studies': len(bps), 'reference_s': seconds['reference'], 'candidate_s': seconds['candidate'],
+            'speedup': seconds['reference']/seconds['candidate'] if seconds['candidate'] else None, 'outputs': {}}
+    for kind, total in totals.items():
+        mse=total['sq_err']/total['pixels']
+        # None when the candidate is bit-identical to the reference
+        report['outputs'][kind]={'images': total['images'], 'psnr_db': 10*np.log10(255**2/mse) if mse>0 else None,
+                                 'mean_abs_diff': total['abs_err']/total['pixels'], 'max_abs_diff': total['max_abs_diff'],
+                                 'size_ratio': total['bytes']/total['reference_bytes']}
+    return report
+
+def with_settings(generator, **settings):
+    # Copy of generator that renders with other decode/encode settings, sharing its
+    # study index and VQA table
+    candidate=copy.copy(generator)
+    if settings['decode'] not in DECODE_MODES:
+        raise ValueError(f"unknown decode mode {settings['decode']!r}, expected one of {DECODE_MODES}")
+    candidate.decode=settings['decode']
+    candidate.output_format=settings['output_format']
+    candidate.save_params=save_params(settings['output_format'], settings['quality'], settings['compress_level'])
+    return candidate
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mimic-eye-path", type=str, default='physionet.org/files/mimic-eye')
+    parser.add_argument("--mimic-cxr-path", type=str, default='physionet.org/files/mimic-cxr/2.0.0')
+    parser.add_argument("--mimic-cxr-vqa-path", type=str, default='physionet.org/files/mimic-ext-mimic-cxr-vqa/1.0.0')
+    parser.add_argument("--study-index", type=str, default='mimic-eye-study-index.pkl')
+    parser.add_argument("--gaze-store", type=str, default=None)
+    parser.add_argument("--studies", type=int, default=50, help="number of studies to render with both settings")
+    parser.add_argument("--decode", type=str, default='draft', choices=DECODE_MODES)
+    parser.add_argument("--output-format", type=str, default='png', choices=sorted(OUTPUT_FORMATS))
+    parser.add_argument("--quality", type=int, default=None)
+    parser.add_argument("--compress-level", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None, help="write the report as JSON")
+    args = parser.parse_args()
+
+    reference=GazeHeatMapGenerator(mimic_eye_path=args.mimic_eye_path,
+                                   mimic_cxr_path=args.mimic_cxr_path,
+                                   mimic_cxr_vqa_path=args.mimic_cxr_vqa_path,
+                                   study_index_path=args.study_index,
+                                   gaze_store_path=args.gaze_store)
+    candidate=with_settings(reference, decode=args.decode, output_format=args.output_format,
+                            quality=args.quality, compress_level=args.compress_level)
+    bps=[bp for bp in reference.patient_subjects if bp.split('/patient_')[-1].split('/')[0] not in reference.remove_list][:args.studies]
+    report=compare_settings(reference, candidate, bps)
+    report['settings']={'decode': args.decode, 'output_format': args.output_format, 'quality': args.quality, 'compress_level': args.compress_level}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    print(f"{report['studies']} studies, render time x{report['speedup']:.2f} faster")
+    for kind, metrics in report['outputs'].items():
+        psnr='identical' if metrics['psnr_db'] is None else f"PSNR {metrics['psnr_db']:.2f} dB"
+        print(f"{kind:16s} {psnr:18s} mean |diff| {metrics['mean_abs_diff']:.3f}  max |diff| {metrics['max_abs_diff']:3d}  size x{metrics['size_ratio']:.2f}")
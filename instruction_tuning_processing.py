@@ -2,7 +2,8 @@ import json
 import pandas as pd
 from tqdm import tqdm
 import os
-from random import shuffle
+import random
+import tempfile
 
 choices_dict={"remove": "Y", "insert": "Y", "replace": "Y", "original": "N"}
 
@@ -59,19 +60,56 @@ def process_dict_sum(di, idx, dataset='reflacx'):
 
 
 
-def process_train():
-    with open('mimic-eye-heat-train.json') as f:
-        d=json.loads(f.read())
-    vqa_data_dict=[process_dict_vqa(di, idx) for idx, di in enumerate(d)]
-    ddx_data_dict=[process_dict_ddx(di, idx) for idx, di in enumerate(d)]
-    #err_data_dict=[process_dict_err(di, idx) for idx, di in enumerate(d)]
-    gen_data_dict=[process_dict_gen(di, idx) for idx, di in enumerate(d)]
-    sum_data_dict=[process_dict_sum(di, idx) for idx, di in enumerate(d)]
-    #miccai_data_dict=err_data_dict+vqa_data_dict+ddx_data_dict+gen_data_dict+sum_data_dict
-    miccai_data_dict=vqa_data_dict+ddx_data_dict+gen_data_dict+sum_data_dict
-    shuffle(miccai_data_dict)
-    with open('instruction_miccai_heatmap.json', 'w') as fi:
-        fi.write(json.dumps(miccai_data_dict))
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def external_shuffle(lines, output_path, num_buckets=64, seed=None):
+    # Scatter lines into random bucket files, then shuffle each bucket in memory;
+    # the result is a uniform permutation while holding one bucket at a time.
+    # The output is written as a single JSON array.
+    rng=random.Random(seed)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        buckets=[open(os.path.join(tmp_dir, f'{i}.jsonl'), 'w') for i in range(num_buckets)]
+        try:
+            for line in lines:
+                buckets[rng.randrange(num_buckets)].write(line+"\n")
+        finally:
+            for bucket in buckets:
+                bucket.close()
+        first=True
+        with open(output_path, 'w') as fi:
+            fi.write('[')
+            for i in range(num_buckets):
+                with open(os.path.join(tmp_dir, f'{i}.jsonl')) as bucket:
+                    bucket_lines=bucket.read().splitlines()
+                rng.shuffle(bucket_lines)
+                for line in bucket_lines:
+                    fi.write(line if first else ', '+line)
+                    first=False
+            fi.write(']')
+
+TASKS=[process_dict_vqa, process_dict_ddx, process_dict_gen, process_dict_sum]
+#TASKS=[process_dict_err, process_dict_vqa, process_dict_ddx, process_dict_gen, process_dict_sum]
+
+def iter_instructions(d, tasks=TASKS):
+    for idx, di in enumerate(d):
+        for task in tasks:
+            yield json.dumps(task(di, idx))
+
+def process_train(input_path='mimic-eye-heat-train.jsonl', output_path='instruction_miccai_heatmap.json', num_buckets=64, seed=None):
+    external_shuffle(iter_instructions(read_jsonl(input_path)), output_path, num_buckets=num_buckets, seed=seed)
 
 if __name__ == '__main__':
-    process_train()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default='mimic-eye-heat-train.jsonl')
+    parser.add_argument("--output", type=str, default='instruction_miccai_heatmap.json')
+    parser.add_argument("--num-buckets", type=int, default=64, help="shuffle buckets; peak memory is about output size / num_buckets")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    process_train(args.input, args.output, num_buckets=args.num_buckets, seed=args.seed)
@@ -0,0 +1,97 @@
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from profiling import NULL_PROFILE
+
+# Thread-based helpers that overlap file I/O with rendering. JPEG decoding, PNG
+# encoding and pandas CSV parsing release the GIL for most of their run time, so
+# a few threads are enough to hide filesystem latency.
+
+def completed_future(fn, *args):
+    # Run fn now and wrap its result or exception in a Future
+    future=Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def prefetch(fn, items, depth=4):
+    # Yields (item, future of fn(item)) in order while fn runs on up to `depth`
+    # items ahead of the consumer; depth=0 calls fn lazily in the caller's thread
+    if depth<=0:
+        for item in items:
+            yield item, completed_future(fn, item)
+        return
+    executor=ThreadPoolExecutor(depth)
+    pending=deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+            if len(pending)>depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def save_image(image, path, **params):
+    # PIL formats by extension; .npy stores the raw uint8 pixels. JPEG has no alpha,
+    # so RGBA images (opaque after compositing) are written as RGB
+    if path.endswith('.npy'):
+        np.save(path, np.asarray(image))
+    elif path.endswith(('.jpg', '.jpeg')) and image.mode=='RGBA':
+        image.convert('RGB').save(path, **params)
+    else:
+        image.save(path, **params)
+
+class BackgroundWriter:
+    # Saves PIL images on background threads and closes them afterwards. At most
+    # `depth` images are queued or being written, save() blocks beyond that so
+    # memory stays bounded; depth=0 saves synchronously. Futures resolve to the path.
+    def __init__(self, depth=8, threads=1):
+        self.executor=ThreadPoolExecutor(threads) if depth>0 else None
+        self.slots=threading.BoundedSemaphore(depth) if depth>0 else None
+        self.submitted=[]
+
+    def _save(self, image, path, profile, stage, params):
+        try:
+            with profile.stage(stage):
+                save_image(image, path, **params)
+            profile.wrote(path)
+            return path
+        finally:
+            image.close()
+
+    def save(self, image, path, profile=NULL_PROFILE, stage='png_encode', **params):
+        if self.executor is None:
+            future=completed_future(lambda: self._save(image, path, profile, stage, params))
+            future.result()
+        else:
+            self.slots.acquire()
+            try:
+                future=self.executor.submit(self._save, image, path, profile, stage, params)
+            except:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda _: self.slots.release())
+        self.submitted.append(future)
+        return future
+
+    def take(self):
+        # Futures of the saves since the previous call, e.g. one study's outputs
+        submitted, self.submitted=self.submitted, []
+        return submitted
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,119 @@
+import os
+import csv
+import json
+import time
+import cProfile
+import numpy as np
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_bytes():
+    # High-water mark of the current process; ru_maxrss is KiB on Linux, bytes on macOS
+    if resource is None:
+        return None
+    maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname=='Darwin' else maxrss*1024
+
+class NullProfile:
+    # Stand-in used when profiling is off so instrumented code needs no branches
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def read(self, path=None, nbytes=None):
+        pass
+
+    def wrote(self, path=None, nbytes=None):
+        pass
+
+    def mark_rendered(self):
+        pass
+
+NULL_PROFILE=NullProfile()
+
+class StudyProfile(NullProfile):
+    # Wall time per stage plus bytes read/written for one study
+    def __init__(self, study):
+        self.study=study
+        self.stages={}
+        self.bytes_read=0
+        self.bytes_written=0
+        self.rendered=False
+        self.start=time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name]=self.stages.get(name, 0.0)+time.perf_counter()-start
+
+    def read(self, path=None, nbytes=None):
+        self.bytes_read+=nbytes if nbytes is not None else os.path.getsize(path)
+
+    def wrote(self, path=None, nbytes=None):
+        self.bytes_written+=nbytes if nbytes is not None else os.path.getsize(path)
+
+    def mark_rendered(self):
+        # Studies that are removed or reused from the manifest stay unmarked
+        self.rendered=True
+
+    def as_dict(self):
+        # total_s is the time spent in the study's own stages. latency_s runs from the
+        # profile's creation, e.g. when the study was prefetched, to now, so it also
+        # includes waiting behind other studies in the pipeline. The peak RSS is the
+        # process's high-water mark so far, not the study's own
+        return {'study': self.study, 'rendered': self.rendered, 'total_s': sum(self.stages.values()), 'latency_s': time.perf_counter()-self.start,
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'process_peak_rss_bytes': peak_rss_bytes(), 'pid': os.getpid(),
+                **{f'{name}_s': seconds for name, seconds in self.stages.items()}}
+
+@contextmanager
+def cprofile_hook(output_dir, study):
+    # Per-study cProfile dump, readable with pstats or snakeviz
+    os.makedirs(output_dir, exist_ok=True)
+    profiler=cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_dir, f'{study}.prof'))
+
+def summarize_profiles(profiles, percentiles=(50, 90, 99), slowest=20):
+    # Percentiles of every per-study column across rendered studies, the slowest
+    # studies, and the peak RSS of every process
+    rss={}
+    for p in profiles:
+        if p.get('process_peak_rss_bytes') is not None:
+            rss[p['pid']]=max(rss.get(p['pid'], 0), p['process_peak_rss_bytes'])
+    rendered=[p for p in profiles if p.get('rendered', True)]
+    summary={'studies': len(rendered), 'not_rendered': len(profiles)-len(rendered),
+             'process_peak_rss_bytes': rss, 'metrics': {}}
+    profiles=rendered
+    columns=sorted({k for p in profiles for k in p if k not in ('study', 'pid', 'rendered', 'process_peak_rss_bytes')})
+    for column in columns:
+        values=np.array([p[column] for p in profiles if p.get(column) is not None], dtype=float)
+        if len(values)==0:
+            continue
+        metric={f'p{q}': float(np.percentile(values, q)) for q in percentiles}
+        metric.update({'mean': float(values.mean()), 'max': float(values.max()), 'sum': float(values.sum())})
+        summary['metrics'][column]=metric
+    ranked=sorted(profiles, key=lambda p: p['total_s'], reverse=True)[:slowest]
+    summary['slowest']=[{'study': p['study'], 'total_s': p['total_s']} for p in ranked]
+    return summary
+
+def write_profiles(profiles, output_prefix):
+    # <prefix>.csv holds one row per study, <prefix>.json the summary
+    columns=['study', 'total_s', 'latency_s', 'bytes_read', 'bytes_written', 'process_peak_rss_bytes', 'pid', 'rendered']
+    columns+=sorted({k for p in profiles for k in p}-set(columns))
+    with open(output_prefix+'.csv', 'w', newline='') as f:
+        writer=csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(profiles)
+    with open(output_prefix+'.json', 'w') as f:
+        json.dump(summarize_profiles(profiles), f, indent=1)
@@ -2,7 +2,7 @@ import json
 import pandas as pd
 from tqdm import tqdm
 import os
-from random import shuffle
+from contextlib import ExitStack
 
 choices_dict={"remove": "Y", "insert": "Y", "replace": "Y", "original": "N"}
 
@@ -21,83 +21,86 @@ PROMPT = {
                 "Use this eye gaze information to answer the question.\n"),
 }
 
+# The system prompt of the released evaluation files is not part of this repository
+SYSTEM = {
+'DEFAULT':(""),
+}
+
+# Each task returns (text after the precompiled prefix, answer key, answer)
+def task_ddx(di):
+    return "", 'differential_diagnosis', di['differential_diagnosis'].strip()
+
+def task_err(di):
+    return f"{di['findings_mod']}\nY. mistakes or errors in findings.\nN. no mistakes or no errors in findings.\n", 'label', di['label'].strip()
+
+def task_gen(di):
+    return "", 'findings', di['findings_org'].strip()
+
+def task_sum(di):
+    return f"{di['findings_org']}\nY. mistakes or errors in findings.\nN. no mistakes or no errors in findings.\nImpression: ", 'impression', di['impression'].strip()
+
+def task_vqa(di):
+    return f"{di['question']}\nY. yes.\nN. no.\n", 'answer', di['answer'].strip()
+
+TASKS = {'DDX': task_ddx, 'ERR': task_err, 'GEN': task_gen, 'SUM': task_sum, 'VQA': task_vqa}
+DEFAULT_TASKS = ['DDX', 'GEN', 'SUM', 'VQA']
+MODES = {'default': 'image_id', 'heatmap': 'heatmap_image_id'}
+
+def task_prefix(task, image_id='image_id'):
+    return (PROMPT['HEATMAP_DESC'] if image_id=='heatmap_image_id' else "")+PROMPT[f'DEFAULT_{task}']
+
+def process_dict(task, di, idx, image_id='image_id', prefix=None):
+    if prefix is None:
+        prefix=task_prefix(task, image_id)
+    text, key, value=TASKS[task](di)
+    return {'image': di[image_id].strip(), 'sys': SYSTEM['DEFAULT'], 'text': prefix+text, 
+            'question_id': idx, key: value}
+
 def process_dict_ddx(di, idx, image_id='image_id'):
-    if image_id=='image_id':    
-        return {'image': di['image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 'text': PROMPT['DEFAULT_DDX'], 
-                'question_id': idx, 'differential_diagnosis': di['differential_diagnosis'].strip()}
-    else:
-        return {'image': di['heatmap_image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 'text': PROMPT['HEATMAP_DESC']+PROMPT['DEFAULT_DDX'], 
-                'question_id': idx, 'differential_diagnosis': di['differential_diagnosis'].strip()}
+    return process_dict('DDX', di, idx, image_id)
 
 def process_dict_err(di, idx, image_id='image_id'):
-    if image_id=='image_id':    
-        return {'image': di['image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 
-                'text': PROMPT['DEFAULT_ERR']+f"{di['findings_mod']}\nY. mistakes or errors in findings.\nN. no mistakes or no errors in findings.\n", 
-                'question_id': idx, 'label': di['label'].strip()}
-    else:
-        return {'image': di['heatmap_image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 
-            'text': 'text': PROMPT['HEATMAP_DESC']+PROMPT['DEFAULT_ERR']+f"{di['findings_mod']}\nY. mistakes or errors in findings.\nN. no mistakes or no errors in findings.\n", 
-            'question_id': idx, 'label': di['label'].strip()}
+    return process_dict('ERR', di, idx, image_id)
 
 def process_dict_gen(di, idx, image_id='image_id'):
-    if image_id=='image_id':    
-        return {'image': di['image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 'text': PROMPT['DEFAULT_GEN'], 
-                'question_id': idx, 'findings': di['findings_org'].strip()}
-    else:
-        return {'image': di['heatmap_image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 'text': PROMPT['HEATMAP_DESC']+PROMPT['DEFAULT_GEN'], 
-                'question_id': idx, 'findings': di['findings_org'].strip()}
+    return process_dict('GEN', di, idx, image_id)
 
 def process_dict_sum(di, idx, image_id='image_id'):
-    if image_id=='image_id':    
-        return {'image': di['image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 
-                'text': PROMPT['DEFAULT_SUM']+f"{di['findings_org']}\nY. mistakes or errors in findings.\nN. no mistakes or no errors in findings.\nImpression: ", 
-                'question_id': idx, 'impression': di['impression'].strip()}
-
-    else:
-        return {'image': di['heatmap_image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 
-                'text': PROMPT['HEATMAP_DESC']+PROMPT['DEFAULT_SUM']+f"{di['findings_org']}\nY. mistakes or errors in findings.\nN. no mistakes or no errors in findings.\nImpression: ", 
-                'question_id': idx, 'impression': di['impression'].strip()}
+    return process_dict('SUM', di, idx, image_id)
 
 def process_dict_vqa(di, idx, image_id='image_id'):
-    if image_id=='image_id':    
-        return {'image': di['image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 
-                'text': PROMPT['DEFAULT_VQA']+f"{di['question']}\nY. yes.\nN. no.\n", 
-                'question_id': idx, 'answer': di['answer'].strip()}
-    else:
-        return {'image': di['heatmap_image_id'].strip(), 'sys': SYSTEM['DEFAULT'], 
-                'text': PROMPT['HEATMAP_DESC']+PROMPT['DEFAULT_VQA']+f"{di['question']}\nY. yes.\nN. no.\n", 
-                'question_id': idx, 'answer': di['answer'].strip()}
-
-def process(d, mode='default'):
-    if mode=='default':
-        image_id='image_id'
-    else:
-        image_id='heatmap_image_id'
-
-    with open(f'DDX/MICCAI_{mode}.jsonl', 'w') as fi:
-        fi.writelines([json.dumps(process_dict_ddx(di, idx, image_id))+"\n" for idx, di in enumerate(d)])
-    # with open(f'ERR/MICCAI_{mode}.jsonl', 'w') as fi:
-    #     fi.writelines([json.dumps(process_dict_err(di, idx, image_id))+"\n" for idx, di in enumerate(d)])
-    with open(f'GEN/MICCAI_{mode}.jsonl', 'w') as fi:
-        fi.writelines([json.dumps(process_dict_gen(di, idx, image_id))+"\n" for idx, di in enumerate(d)])
-    with open(f'SUM/MICCAI_{mode}.jsonl', 'w') as fi:
-        fi.writelines([json.dumps(process_dict_sum(di, idx, image_id))+"\n" for idx, di in enumerate(d)])
-    with open(f'VQA/MICCAI_{mode}.jsonl', 'w') as fi:
-        fi.writelines([json.dumps(process_dict_vqa(di, idx, image_id))+"\n" for idx, di in enumerate(d)])
+    return process_dict('VQA', di, idx, image_id)
+
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def process_stream(d, tasks=DEFAULT_TASKS, modes=('default', 'heatmap'), output_dir='.'):
+    # One pass over d, fanning every record out to <task>/MICCAI_<mode>.jsonl for
+    # all task/mode pairs; d can be any iterable, e.g. read_jsonl(path)
+    outputs=[(task, MODES[mode], task_prefix(task, MODES[mode]), os.path.join(output_dir, task, f'MICCAI_{mode}.jsonl'))
+             for task in tasks for mode in modes]
+    with ExitStack() as stack:
+        files=[]
+        for task, image_id, prefix, path in outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            files.append((task, image_id, prefix, stack.enter_context(open(path, 'w'))))
+        for idx, di in enumerate(d):
+            for task, image_id, prefix, fi in files:
+                fi.write(json.dumps(process_dict(task, di, idx, image_id, prefix))+"\n")
+
+def process(d, mode='default', tasks=DEFAULT_TASKS):
+    process_stream(d, tasks=tasks, modes=[mode])
 
 if __name__ == '__main__':
-    if not os.path.exists('DDX'):
-        os.makedirs('DDX')
-    if not os.path.exists('GEN'):
-        os.makedirs('GEN')
-    if not os.path.exists('SUM'):
-        os.makedirs('SUM')
-    if not os.path.exists('VQA'):
-        os.makedirs('VQA')
-    if not os.path.exists('ERR'):
-        os.makedirs('ERR')
-        
-    with open('mimic-eye-heat-test.json') as f:
-        d=json.loads(f.read())
-    process(d, mode='default')
-    process(d, mode='heatmap')
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default='mimic-eye-heat-test.jsonl')
+    parser.add_argument("--tasks", type=str, nargs='+', default=DEFAULT_TASKS, choices=sorted(TASKS), help="ERR needs findings_mod and label in the input")
+    parser.add_argument("--output-dir", type=str, default='.')
+    args = parser.parse_args()
+
+    process_stream(read_jsonl(args.input), tasks=args.tasks, output_dir=args.output_dir)
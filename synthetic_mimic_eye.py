@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+# Writes a small MIMIC-Eye / MIMIC-CXR / MIMIC-Ext-CXR-VQA tree with the layout
+# GazeHeatMapGenerator expects, filled with random but well-formed data, so the
+# pipeline can be run and benchmarked without credentialed PhysioNet access.
+
+DX_COLUMNS=[f'dx{i}' for i in range(1, 10)]
+DISEASES=['atelectasis', 'cardiomegaly', 'consolidation', 'edema', 'effusion', 'pneumonia', 'pneumothorax', 'nodule', 'fracture']
+QUESTIONS=['Is there evidence of {} in the image?', 'Does the x-ray show {}?', 'Which findings are related to {}?']
+
+def synthetic_cxr(rng, width, height):
+    # Smooth low-frequency structure plus noise, upscaled so encoding cost is realistic
+    small=rng.normal(128, 40, (height//32, width//32)).clip(0, 255).astype(np.uint8)
+    image=np.asarray(Image.fromarray(small).resize((width, height), Image.BILINEAR), dtype=np.int16)
+    image=image+rng.integers(-12, 12, (height, width), dtype=np.int16)
+    return Image.fromarray(image.clip(0, 255).astype(np.uint8), 'L')
+
+def synthetic_fixations(rng, width, height, n):
+    start=np.cumsum(rng.uniform(0.05, 0.6, n))
+    end=start+rng.uniform(0.05, 0.5, n)
+    # A few fixations land outside the image, like real gaze data
+    x=rng.normal(width/2, width/4, n)
+    y=rng.normal(height/2, height/4, n)
+    return x, y, start, end
+
+def generate_synthetic_tree(root, patients=20, seed=0, image_size=(2048, 2500), eg_fraction=0.5,
+                            fixations=(40, 300), duplicate_subjects=1):
+    # Returns the three dataset roots to pass to GazeHeatMapGenerator
+    rng=np.random.default_rng(seed)
+    mimic_eye_path=os.path.join(root, 'mimic-eye')
+    mimic_cxr_path=os.path.join(root, 'mimic-cxr')
+    mimic_cxr_vqa_path=os.path.join(root, 'mimic-ext-mimic-cxr-vqa')
+    os.makedirs(os.path.join(mimic_eye_path, 'spreadsheets/CXR-JPG'), exist_ok=True)
+    os.makedirs(os.path.join(mimic_cxr_path, 'mimic-cxr-sections'), exist_ok=True)
+    os.makedirs(mimic_cxr_vqa_path, exist_ok=True)
+
+    meta, split, reports, vqa=[], [], [], []
+    for p in range(patients):
+        patient_id=10000000+p
+        study_id=f's{50000000+p}'
+        dicom_id=f'{rng.integers(0, 16**8):08x}-{p:06d}'
+        EG=rng.random()<eg_fraction
+        width, height=(int(v*rng.uniform(0.9, 1.1)) for v in image_size)
+        if rng.random()<0.3:
+            width, height=height, width
+
+        study_path=os.path.join(mimic_eye_path, f'patient_{patient_id}/CXR-JPG/{study_id}')
+        os.makedirs(study_path, exist_ok=True)
+        synthetic_cxr(rng, width, height).save(os.path.join(study_path, f'{dicom_id}.jpg'), quality=95)
+
+        x, y, start, end=synthetic_fixations(rng, width, height, int(rng.integers(*fixations)))
+        diseases=list(rng.choice(DISEASES, size=int(rng.integers(1, 5)), replace=False))
+        if EG:
+            gaze_path=os.path.join(mimic_eye_path, f'patient_{patient_id}/EyeGaze')
+            os.makedirs(gaze_path, exist_ok=True)
+            pd.DataFrame({'Time (in secs)': end, 'X_ORIGINAL': x, 'Y_ORIGINAL': y, 'transcript': ''}).to_csv(os.path.join(gaze_path, 'fixations.csv'), index=False)
+            master_sheet={'gender': rng.choice(['F', 'M']), 'anchor_age': int(rng.integers(20, 90)), 'cxr_exam_indication': 'Shortness of breath.'}
+            master_sheet.update({dx: (diseases[i] if i<len(diseases) else None) for i, dx in enumerate(DX_COLUMNS)})
+            pd.DataFrame([master_sheet]).to_csv(os.path.join(gaze_path, 'master_sheet.csv'), index=False)
+        else:
+            # An empty reading directory first exercises the fallback over main_data/*
+            main_data=os.path.join(mimic_eye_path, f'patient_{patient_id}/REFLACX/main_data')
+            os.makedirs(os.path.join(main_data, f'P{p:03d}R000000'), exist_ok=True)
+            os.makedirs(os.path.join(main_data, f'P{p:03d}R000001'), exist_ok=True)
+            pd.DataFrame({'timestamp_start_fixation': start, 'timestamp_end_fixation': end, 'x_position': x, 'y_position': y, 'transcript': ''}).to_csv(os.path.join(main_data, f'P{p:03d}R000001/fixations.csv'), index=False)
+
+        meta.append({'subject_id': patient_id, 'study_id': study_id, 'dicom_id': dicom_id, 'in_eye_gaze': EG, 'in_reflacx': not EG})
+        split.append({'subject_id': patient_id, 'dicom_id': dicom_id, 'study_id': study_id, 'split': rng.choice(['train', 'validate', 'test'], p=[0.8, 0.1, 0.1])})
+        reports.append({'study': study_id,
+                        'impression': f'Findings consistent with {diseases[0]}.\n\n No other acute process.',
+                        'findings': '  '.join(f'There is {d}.\n' for d in diseases)})
+        # Same image path form as the image_id written by process_patient so the VQA join matches
+        image_path=f'/patient_{patient_id}/CXR-JPG/{study_id}/{dicom_id}_512.png'
+        for d in rng.choice(DISEASES, size=4, replace=False):
+            answer=['yes'] if d in diseases else ['no']
+            vqa.append({'image_path': image_path, 'question': QUESTIONS[0].format(d), 'answer': answer})
+        vqa.append({'image_path': image_path, 'question': QUESTIONS[2].format(diseases[0]), 'answer': list(diseases)})
+        vqa.append({'image_path': image_path, 'question': QUESTIONS[1].format('a device'), 'answer': []})
+
+    # Subjects listed twice in cxr_meta.csv are dropped by the generator
+    for p in range(min(duplicate_subjects, len(meta))):
+        meta.append(dict(meta[p], dicom_id=meta[p]['dicom_id']+'-dup'))
+
+    pd.DataFrame(meta).to_csv(os.path.join(mimic_eye_path, 'spreadsheets/cxr_meta.csv'), index=False)
+    pd.DataFrame(split).to_csv(os.path.join(mimic_eye_path, 'spreadsheets/CXR-JPG/cxr_split.csv'), index=False)
+    pd.DataFrame(reports).to_csv(os.path.join(mimic_cxr_path, 'mimic-cxr-sections/mimic_cxr_sectioned.csv'), index=False)
+    order=rng.permutation(len(vqa))
+    for name, part in zip(['train', 'valid', 'test'], np.array_split(order, 3)):
+        with open(os.path.join(mimic_cxr_vqa_path, f'{name}.json'), 'w') as f:
+            json.dump([vqa[i] for i in sorted(part)], f)
+    return {'mimic_eye_path': mimic_eye_path, 'mimic_cxr_path': mimic_cxr_path, 'mimic_cxr_vqa_path': mimic_cxr_vqa_path}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default='synthetic-physionet')
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image-size", type=int, nargs=2, default=[2048, 2500], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument("--eg-fraction", type=float, default=0.5, help="share of patients with EyeGaze instead of REFLACX fixations")
+    args = parser.parse_args()
+
+    paths=generate_synthetic_tree(args.output, patients=args.patients, seed=args.seed,
+                                  image_size=tuple(args.image_size), eg_fraction=args.eg_fraction)
+    print(' '.join(f"--{k.replace('_', '-')} {v}" for k, v in paths.items()))
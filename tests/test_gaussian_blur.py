@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from gaussian_blur import BLUR_BACKENDS, blur_scipy, gaussian_blur
+
+# Tolerance relative to the peak of the reference; separable runs in float32
+TOLERANCE={'stamp': 1e-10, 'separable': 1e-5}
+
+def sparse_map(seed, shape, n, border):
+    # n fixation-like impulses, a third of them inside the `border` band along the
+    # edges where blur_stamp folds its stamp back with reflect indexing
+    rng=np.random.default_rng(seed)
+    height, width=shape[-2:]
+    intensity_map=np.zeros(shape)
+    for layer in intensity_map.reshape(-1, height, width):
+        for i in range(n):
+            if i%3==0:
+                y=rng.integers(0, border) if rng.random()<0.5 else rng.integers(height-border, height)
+                x=rng.integers(0, width)
+            else:
+                y, x=rng.integers(0, height), rng.integers(0, width)
+            layer[y, x]+=rng.uniform(0.05, 1.5)
+    return intensity_map
+
+def assert_close(result, expected, backend):
+    peak=np.abs(expected).max()
+    assert result.shape==expected.shape
+    assert np.abs(result-expected).max()<=TOLERANCE[backend]*peak
+
+@pytest.mark.parametrize('backend', ['stamp', 'separable'])
+@pytest.mark.parametrize('sigma', [5, 3.5, 8.25])
+@pytest.mark.parametrize('shape', [(80, 96), (97, 64)])
+def test_backend_matches_scipy(backend, sigma, shape):
+    intensity_map=sparse_map(0, shape, 40, border=int(4*sigma+0.5))
+    assert_close(gaussian_blur(intensity_map, sigma, backend), blur_scipy(intensity_map, sigma), backend)
+
+@pytest.mark.parametrize('backend', ['stamp', 'separable'])
+def test_backend_matches_scipy_on_corners(backend):
+    # Impulses in all four corners fold back along both axes at once
+    intensity_map=np.zeros((48, 56))
+    intensity_map[[0, 0, 47, 47, 2], [0, 55, 0, 55, 3]]=[1.0, 0.5, 0.25, 2.0, 0.75]
+    assert_close(gaussian_blur(intensity_map, 4.5, backend), blur_scipy(intensity_map, 4.5), backend)
+
+@pytest.mark.parametrize('backend', ['stamp', 'separable'])
+def test_backend_matches_scipy_on_batch(backend):
+    # Stacked maps are blurred independently, only along the last two axes
+    intensity_map=sparse_map(1, (3, 64, 72), 25, border=14)
+    result=gaussian_blur(intensity_map, 3.5, backend)
+    assert_close(result, blur_scipy(intensity_map, 3.5), backend)
+    for layer, blurred in zip(intensity_map, result):
+        assert_close(blurred, blur_scipy(layer, 3.5), backend)
+
+@pytest.mark.parametrize('backend', ['stamp', 'separable'])
+def test_backend_matches_scipy_on_map_smaller_than_kernel(backend):
+    # 4 sigma exceeds the map, so the kernel reflects off both edges more than once
+    intensity_map=sparse_map(2, (9, 13), 6, border=3)
+    assert_close(gaussian_blur(intensity_map, 5, backend), blur_scipy(intensity_map, 5), backend)
+
+def test_empty_map_stays_empty():
+    for backend in BLUR_BACKENDS:
+        assert not gaussian_blur(np.zeros((32, 40)), 5, backend).any()
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        gaussian_blur(np.zeros((8, 8)), 1, 'fft')
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image, ImageDraw
+from scipy.ndimage import gaussian_filter
+
+from heatmap_dataset_processing import generate_heatmap
+
+def reference_heatmap(base_image, width, height, x_ratio, y_ratio, gaze_data, radius=5, _x='x_position', _y='y_position'):
+    # The original per-pixel ImageDraw.point renderer
+    data=gaze_data.to_dict(orient='records')
+    heatmap_image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(heatmap_image)
+    intensity_map = np.zeros((height, width))
+    for gaze in data:
+        x, y = gaze[_x]*x_ratio, gaze[_y]*y_ratio
+        x=int(x)
+        y=int(y)
+        if y>=height-radius or y<0+radius  or x<0+radius  or x>=width-radius:
+            continue
+        intensity_map[y][x] += gaze['Time (in secs)']
+    intensity_map = gaussian_filter(intensity_map, sigma=radius)
+    intensity_map /= np.max(intensity_map)
+    for y in range(height):
+        for x in range(width):
+            intensity = min(255, max(0, int(intensity_map[y][x] * 255)))
+            draw.point((x, y), fill=(255 - intensity, 0, 0, intensity))
+    return heatmap_image
+
+def random_gaze(seed, n, width, height):
+    # Fixations spread beyond the image on every side, including negative coordinates
+    rng=np.random.default_rng(seed)
+    return pd.DataFrame({'x_position': rng.uniform(-0.2*width, 1.2*width, n),
+                         'y_position': rng.uniform(-0.2*height, 1.2*height, n),
+                         'Time (in secs)': rng.uniform(0.01, 1.5, n)})
+
+@pytest.mark.parametrize('seed, n, radius', [(0, 200, 5), (1, 30, 3), (2, 1, 5), (3, 500, 8)])
+def test_generate_heatmap_matches_reference(seed, n, radius):
+    width, height, source_width, source_height=96, 80, 2048, 2500
+    gaze_data=random_gaze(seed, n, source_width, source_height)
+    # Guarantee at least one fixation inside the drawable area
+    gaze_data.loc[0, ['x_position', 'y_position']]=[source_width/2, source_height/2]
+    args=(None, width, height, width/source_width, height/source_height, gaze_data, radius)
+    expected=np.asarray(reference_heatmap(*args))
+    result=np.asarray(generate_heatmap(*args))
+    assert result.dtype==np.uint8 and result.shape==(height, width, 4)
+    assert np.array_equal(result, expected)
+
+def test_generate_heatmap_custom_columns():
+    gaze_data=random_gaze(4, 100, 64, 64).rename(columns={'x_position': 'X_ORIGINAL', 'y_position': 'Y_ORIGINAL'})
+    gaze_data.loc[0, ['X_ORIGINAL', 'Y_ORIGINAL']]=[32, 32]
+    args=(None, 64, 64, 1.0, 1.0, gaze_data, 5, 'X_ORIGINAL', 'Y_ORIGINAL')
+    assert np.array_equal(np.asarray(generate_heatmap(*args)), np.asarray(reference_heatmap(*args)))
+
+def test_generate_heatmap_empty_map_is_transparent():
+    # Every fixation falls in the border band or outside the image; the reference
+    # renderer fails here on the NaN cast, the vectorized one renders nothing
+    gaze_data=pd.DataFrame({'x_position': [-10.0, 2.0, 63.0, 500.0], 'y_position': [30.0, 2.0, 62.0, 30.0],
+                            'Time (in secs)': [0.5, 0.5, 0.5, 0.5]})
+    result=np.asarray(generate_heatmap(None, 64, 64, 1.0, 1.0, gaze_data))
+    assert result.shape==(64, 64, 4)
+    assert (result[..., 3]==0).all()
+    with pytest.raises(ValueError), np.errstate(invalid='ignore'):
+        reference_heatmap(None, 64, 64, 1.0, 1.0, gaze_data)
+
+def test_render_batch_matches_generate_heatmap():
+    # The batch API stacks studies of different sizes and radii; without augmentation
+    # and with the scipy backend every overlay equals the single-study renderer
+    from heatmaps import render_batch
+    image_sizes=[(2048, 2500), (2500, 2048), (2048, 2500), (1900, 2300)]
+    gaze=[random_gaze(10+i, 150, *size) for i, size in enumerate(image_sizes)]
+    fixations=[{'x': g['x_position'].to_numpy(), 'y': g['y_position'].to_numpy(), 'duration': g['Time (in secs)'].to_numpy()} for g in gaze]
+    batch=render_batch(fixations, image_sizes, 128, radius_range=(5, 5), blur_backend='scipy')
+    assert batch['overlay'].shape==(4, 128, 128, 4)
+    for i, ((width, height), g) in enumerate(zip(image_sizes, gaze)):
+        target_width, target_height=batch['size'][i]
+        inside=(g['x_position']>0)&(g['y_position']>0)&(g['x_position']<width)&(g['y_position']<height)
+        expected=np.asarray(generate_heatmap(None, target_width, target_height, target_width/width, target_height/height, g[inside]))
+        assert np.array_equal(batch['overlay'][i, :target_height, :target_width], expected)
+        assert not batch['overlay'][i, target_height:, target_width:].any()
@@ -0,0 +1,42 @@
+import json
+import pytest
+
+from heatmap_dataset_processing import iter_json_array
+
+ARRAYS=['[12, 3]', ' [ 100000 ] ', '[]', '[1.5e10,true,null,"ab,c]",{"a":[1,2]}, -7 ]',
+        '[{"image_path": "/patient_1/CXR-JPG/s2/d_512.png", "question": "Is there edema?", "answer": ["no"]}]']
+
+@pytest.mark.parametrize('text', ARRAYS)
+def test_iter_json_array_across_chunk_boundaries(tmp_path, text):
+    # Every chunk size splits some number, literal or string mid-token
+    path=tmp_path/'a.json'
+    path.write_text(text)
+    for chunk_size in range(1, len(text)+2):
+        assert list(iter_json_array(str(path), chunk_size))==json.loads(text)
+
+@pytest.mark.parametrize('text', ['[1, 2', '[1 2]', '{}', '[{"a": ', '[,1]', '[1,,2]', '[1,]'])
+def test_iter_json_array_rejects_malformed(tmp_path, text):
+    path=tmp_path/'a.json'
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), 2))
+
+@pytest.mark.parametrize('spelling', ['trailing_slash', 'dot'])
+def test_image_ids_do_not_depend_on_path_spelling(tmp_path, monkeypatch, spelling):
+    from heatmap_dataset_processing import GazeHeatMapGenerator, vqa_image_path
+    from synthetic_mimic_eye import generate_synthetic_tree
+    paths=generate_synthetic_tree(str(tmp_path/'phys'), patients=3, image_size=(200, 240), fixations=(5, 20))
+    if spelling=='dot':
+        monkeypatch.chdir(paths['mimic_eye_path'])
+        paths['mimic_eye_path']='.'
+    else:
+        paths['mimic_eye_path']+='/'
+    generator=GazeHeatMapGenerator(**paths, study_index_path=str(tmp_path/'index.pkl'))
+    bps=[bp for bp in generator.patient_subjects if bp.split('/patient_')[-1].split('/')[0] not in generator.remove_list]
+    record=generator.process_patient(bps[0])
+    study_id=bps[0].split('/')[-1]
+    study=generator.studies[study_id]
+    prefix=f"/patient_{study['patient_id']}/CXR-JPG/{study_id}/{study['dicom_id']}"
+    assert record['image_id']==prefix+'_512.png'
+    assert record['heatmap_image_id']==prefix+'_heatmap.png'
+    assert vqa_image_path(record['image_id']) in generator.image_ids()